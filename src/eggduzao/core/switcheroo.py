@@ -40,231 +40,4188 @@ So:
 Safety / traversal
 ------------------
 - Walk is bottom-up (topdown=False) to avoid missing children when renaming parents.
+  It is built on `os.scandir` and reuses the `DirEntry` type data, so files
+  cost no extra lstat, and collisions are checked against an in-memory set
+  of each directory's names (case-folded on case-insensitive filesystems).
 - Contents are edited BEFORE renaming file names.
 - Skips symlinks.
 - Only edits files decodable as UTF-8 (BOM allowed). Others are skipped.
+- Files are read as bytes and pre-scanned before decoding: pure-ASCII files
+  with no byte-level match are rejected without ever building a `str`.
+- Edits are byte-exact outside matched spans (BOM and line endings are kept).
+- Files sharing the same bytes (vendored copies, licenses, ...) are matched
+  once per worker: past the prefilter, each file is keyed by the SHA-256 of
+  its contents, and repeats reuse the cached outcome and rewritten bytes
+  (`--no-dedup` turns this off).
+- ASCII files from `--mmap-threshold` (default 1 MiB; 0 turns it off) up to
+  the stream threshold are never decoded: matches are found on a memory map
+  of the raw bytes, and the new file is written with `os.writev` from
+  slices of the map around the encoded replacements. `--stats` reports the
+  bytes passed through unchanged vs the bytes actually replaced. They skip
+  the dedup cache, and (like streamed files) the new file replaces the old
+  one: a new inode, so hardlinks to it are broken and its owner becomes
+  the user running the tool; smaller files are rewritten in place.
+- Files above `--stream-threshold` are rewritten chunk by chunk into a temp
+  file that atomically replaces the original, so memory stays flat. There,
+  matches longer than `--max-match-len` characters may be missed.
 - If a rename would collide with an existing path, it is skipped (logged).
+  Renames go through a directory fd opened once per directory (`os.rename`
+  with `src_dir_fd`/`dst_dir_fd`), and on Linux use RENAME_NOREPLACE, so a
+  path appearing after the check is never clobbered.
+
+Skipping files
+--------------
+- Before a file is read, `--exclude-ext EXT` / `--include-ext EXT`
+  (repeatable) and `--max-size BYTES` decide by name and size alone whether
+  its contents are looked at. Such files are still renamed.
+- Files larger than `--sniff-bytes` (default 8 KiB) are sniffed first: a NUL
+  byte or invalid UTF-8 in that much of the head marks them binary without
+  reading the rest (`--sniff-bytes 0` reads every file whole, and only
+  skips what fails to decode).
+- `--stats` counts skipped files by reason: "extension", "size", "binary",
+  "nonutf8" and "unreadable".
+
+Pruning
+-------
+- `--exclude PATTERN` (repeatable) and `--gitignore` drop paths using
+  gitignore rules (`*`, `**`, `!`, trailing `/`, anchoring, nested files).
+  The walk discovers top-down and prunes ignored directories before listing
+  them, then replays the surviving set bottom-up; `--stats` reports how much
+  was pruned and how long discovery took.
+
+Git checkouts
+-------------
+- `--git` reads `.git/index` directly (no git process) and only handles
+  tracked files. Files whose stat data still matches the index are known by
+  blob id; blobs once found match-free are remembered in the git dir and
+  never read again. Renames are not staged: run `git add -A` afterwards.
+
+Incremental runs
+----------------
+- `--manifest` records files found without a match in a small SQLite file at
+  the root, keyed by path, inode, size, mtime and a fingerprint of the pairs.
+  Later runs skip them while unchanged; `--rebuild-manifest` starts afresh.
+
+Strict mode
+-----------
+- `--strict` only matches the exact spelling, in any case ("fabric",
+  "FABRIC", "fAbRiC", ..., never "fab-ric"). On ASCII text, which is almost
+  all of it, no regex runs at all: matches are found with `str.find` on a
+  lowercased copy.
+
+Multiple pairs
+--------------
+- `--mapping FILE` takes `old<TAB>new` lines and replaces all of them in a
+  single pass. Overlaps resolve leftmost-longest (ties: earlier line wins);
+  replaced text is never re-matched, so `a->b` and `b->c` do not chain.
+
+Plan / apply
+------------
+- `switcheroo.py plan -o PLAN ROOT OLD NEW` scans once and writes every
+  action to PLAN (NDJSON: edits as byte spans plus the file's SHA-256, then
+  renames bottom-up) without touching the tree.
+- `switcheroo.py apply PLAN` replays it without rescanning or matching; files
+  whose hash changed since, and renames whose source vanished, are skipped.
+  (A root directory literally named `plan`, `apply`, `merge-stats` or
+  `undo` needs a `./` prefix.)
+
+Undo
+----
+- `--journal FILE` (a new file, outside the tree; single process only)
+  records every change right before it is made: each edit as the byte
+  offsets and old/new text of its replacements plus the edited file's new
+  SHA-256, each rename as its target.
+- `switcheroo.py undo FILE` reverts them, last first, touching only the
+  recorded paths: its cost follows the number of changes, not the tree.
+  Files not as the run left them (edited since, or never written), and
+  renames whose target is missing or whose old name is taken, are left
+  alone and reported as stale. So a run stopped or crashed anywhere,
+  leaving a journal without its trailer, is undone entirely.
+
+Output directory
+----------------
+- `--output-dir DIR` leaves the tree untouched and builds the renamed copy in
+  DIR (new or empty; DIR itself stands for the root, which is not renamed).
+  Only edited files are written there: the others are hardlinked (default),
+  reflinked (`--link-mode reflink`, on btrfs/XFS/...) or copied, with a copy
+  whenever linking fails, so the cost follows the number of edited files.
+  Symlinks are recreated. Hardlinked files share their inode with the
+  source, so a later in-place run over DIR would write through to it: use
+  `--link-mode reflink` or `copy` if DIR is to be edited again.
+
+Logging
+-------
+- Every rename/collision is an event sent to an `EventSink`: human lines
+  (default), NDJSON (`--log-format ndjson`, ending with a "done" record of
+  the full stats) or nothing (`--quiet`). Lines are written in batches,
+  optionally to `--log-file`, and counted per kind (`--stats`).
+- As a library, `iter_switcheroo()` yields every change as a typed object
+  (`ContentEdit`, `Skip`, `FileRename`, `DirRename`, `Collision`, then
+  `Done` with the stats) as soon as it is made, so callers can pipeline or
+  stop early; `switcheroo()` just drains it into an `EventSink`.
+
+Sharding
+--------
+- `--shard I/N` (1 <= I <= N) edits only the files whose path (relative to
+  the root) hashes to shard I, and renames nothing, so N nodes sharing one
+  filesystem can split the content phase. Once every shard is done, one
+  `--renames-only` run (which reads no file) does all renames, and
+  `switcheroo.py merge-stats A.json B.json ...` sums their `--stats-json`.
+
+Watch mode
+----------
+- `--watch` (needs the `watchfiles` package) makes one full pass, then keeps
+  running until interrupted: bursts of filesystem events are debounced
+  (`--debounce MS`) and coalesced, and only created or modified files, and
+  created directories, go through the content phase and renames. Events
+  caused by its own edits and renames are recognised by their stat data and
+  dropped. The root is renamed by the first pass only.
+
+Parallelism
+-----------
+- `--jobs N` fans the content phase (read -> replace -> write) out to N worker
+  processes. Renames always run afterwards, bottom-up, in the main process.
+- `--prefetch N` (single process only) is for high-latency filesystems (NFS,
+  FUSE, ...) instead: N threads read upcoming files, in walk order, while
+  the main thread matches and writes. At most `--prefetch-depth` files
+  (default 4N) are held read ahead; `--stats` shows the time spent
+  waiting on them as `phase.wait`.
+- `--walk-threads N` lists directories with N threads, for very wide trees
+  on network filesystems where discovery alone takes minutes. Whichever
+  thread is free lists the next queued directory; the listings are then
+  put in the same bottom-up order as a single-threaded walk, so results
+  never depend on scheduling.
 """
 
-from __future__ import annotations
+from __future__ import annotations
+
+import argparse
+import codecs
+import ctypes
+import dataclasses
+import errno
+import functools
+import hashlib
+import heapq
+import io
+import json
+import mmap
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Callable, Generator, Iterable, Iterator, Sequence
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, BinaryIO, TextIO, TypedDict, Unpack
+
+
+@dataclass(frozen=True)
+class Stats:
+    renamed_paths: int = 0
+    edited_files: int = 0
+    skipped_binary_or_nonutf8: int = 0
+    rename_collisions: int = 0
+    prefilter_rejected_files: int = 0
+    prefilter_saved_bytes: int = 0
+    streamed_files: int = 0
+    # "old->new" -> matches replaced (contents and names), one entry per pair.
+    matches_by_pair: dict[str, int] = field(default_factory=dict[str, int])
+    # Filesystem calls made, by kind ("scandir", "stat", "open", "rename", ...).
+    syscalls: dict[str, int] = field(default_factory=dict[str, int])
+    manifest_skipped_files: int = 0
+    # `apply_plan` and `undo_journal` only: planned or journaled edits/renames
+    # whose file changed since.
+    stale_plan_entries: int = 0
+    # Entries dropped by --exclude / .gitignore rules (pruned directories are
+    # counted once, not their contents), and the discovery time.
+    pruned_dirs: int = 0
+    pruned_files: int = 0
+    walk_seconds: float = 0.0
+    # --git only: files not read because their blob id is known match-free.
+    blob_skipped_files: int = 0
+    # Wall and CPU seconds (worker processes included) of the "walk",
+    # "content" and "rename" phases. `phase_seconds` also has per-file steps
+    # summed over all files: "read", "decode" (byte prefilter included),
+    # "hash" (dedup keys; it takes over the prefilter time from "decode"),
+    # "match", "write", "stream" for whole streamed files, and "wait" for
+    # reads prefetched too late (the main thread blocked on them).
+    phase_seconds: dict[str, float] = field(default_factory=dict[str, float])
+    phase_cpu_seconds: dict[str, float] = field(default_factory=dict[str, float])
+    bytes_read: int = 0
+    bytes_written: int = 0
+    # Files through the content phase per wall second of that phase.
+    files_per_second: float = 0.0
+    # (path, size) of the largest files read, biggest first.
+    largest_files: list[tuple[str, int]] = field(default_factory=list[tuple[str, int]])
+    # Matches replaced in file contents, by lowercased suffix ("" for none).
+    matches_by_extension: dict[str, int] = field(default_factory=dict[str, int])
+    # --output-dir only: how each file got there ("written" when edited,
+    # "hardlink", "reflink", "copy", or "failed" when it could not be read).
+    output_files: dict[str, int] = field(default_factory=dict[str, int])
+    # Dedup cache lookups (files past the prefilter, neither streamed nor
+    # memory-mapped): hits skip decoding, matching and encoding. One cache
+    # per worker process.
+    dedup_hits: int = 0
+    dedup_misses: int = 0
+    dedup_hit_bytes: int = 0
+    dedup_hit_rate: float = 0.0
+    # --shard only: files left to the other shards.
+    shard_skipped_files: int = 0
+    # Files whose contents were skipped, by reason: "extension" and "size"
+    # (policies, decided before reading), "binary" (a NUL byte in the sniffed
+    # head), "nonutf8" and "unreadable". `skipped_binary_or_nonutf8` counts
+    # all but the policy skips.
+    skipped_files: dict[str, int] = field(default_factory=dict[str, int])
+    # Edited ASCII files rewritten from a memory map (see --mmap-threshold):
+    # bytes passed through unchanged from the mapping vs bytes of the
+    # matched spans, the only ones ever looked at as text.
+    mmap_files: int = 0
+    mmap_bytes_copied: int = 0
+    mmap_bytes_touched: int = 0
+
+
+# Files at least this large are rewritten in constant memory, chunk by chunk.
+DEFAULT_STREAM_THRESHOLD = 64 * 1024 * 1024
+
+# Longest span (in characters, separators included) a streamed match may
+# cover. Fuzzy separators make matches unbounded in principle; longer ones
+# that straddle a chunk boundary are not found on the streaming path.
+DEFAULT_MAX_MATCH_LEN = 4096
+
+_STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Bytes of a file inspected for NUL bytes / invalid UTF-8 before the rest is read.
+DEFAULT_SNIFF_BYTES = 8192
+
+# ASCII files from this size up to the stream threshold are matched on a
+# memory map and written back around the matches, never decoded.
+DEFAULT_MMAP_THRESHOLD = 1024 * 1024
+
+
+def _iov_max(default: int = 1024) -> int:
+    """Most buffers one `os.writev` call takes here, capped at `default`."""
+    try:
+        limit = os.sysconf("SC_IOV_MAX")
+    except (AttributeError, OSError, ValueError):  # no sysconf (Windows), or unknown name
+        return default
+    # -1: no fixed limit.
+    return min(default, limit) if limit > 0 else default
+
+
+# Most buffers per `os.writev` call.
+_IOV_MAX = _iov_max()
+
+
+# Characters allowed (any number of times) between the letters of `old_string`.
+_SEPARATOR = r"[-_\s]"
+# The same for ASCII bytes: for `str`, `\s` also matches \x1c-\x1f.
+_ASCII_SEPARATOR = r"[-_\s\x1c-\x1f]"
+
+
+def _compile_backtracking_old_pattern(old_string: str) -> re.Pattern[str]:
+    """
+    Plain `l1[-_\\s]*l2[-_\\s]*...` regex. Correct for any `old_string`, but the
+    engine backtracks into every separator run it fails after.
+    """
+    if not old_string or not old_string.islower():
+        raise ValueError("old_string must be a non-empty lowercase string")
+
+    sep = _SEPARATOR + "*"
+    pattern = sep.join(re.escape(ch) for ch in old_string)
+    return re.compile(pattern, flags=re.IGNORECASE)
+
+
+def _compile_fuzzy_old_pattern(old_string: str) -> re.Pattern[str]:
+    """
+    Regex that matches `old_string` case-insensitively, allowing separators between letters.
+
+    Example: old="fabric"
+      matches: "fabric", "Fabric", "FABRIC", "F-A-B-R-I-C", "fabri_c", "f a b r i c"
+      and matches as substring: "fabricate", "refabricated", "my-fabric-module", etc.
+
+    When no character of `old_string` is itself a separator, letters and
+    separators are disjoint, so a separator run can only ever be consumed
+    whole. The runs are then made possessive (`*+`): same matches as
+    `_compile_backtracking_old_pattern`, but the regex runs as a case-folded
+    automaton (letter -> next state, separator -> stay, anything else ->
+    fail) and never backtracks, which keeps it linear on separator-heavy text.
+    """
+    if not old_string or not old_string.islower():
+        raise ValueError("old_string must be a non-empty lowercase string")
+    if any(re.fullmatch(_SEPARATOR, ch) for ch in old_string):
+        return _compile_backtracking_old_pattern(old_string)
+
+    sep = _SEPARATOR + "*+"
+    pattern = sep.join(re.escape(ch) for ch in old_string)
+    return re.compile(pattern, flags=re.IGNORECASE)
+
+
+def _ascii_class(chars: Sequence[str]) -> bytes:
+    return b"[" + b"".join(re.escape(c.encode("ascii")) for c in chars) + b"]"
+
+
+def _ascii_prefilter_source(old_string: str, fuzzy: bool = True) -> bytes | None:
+    """
+    Bytes regex equivalent to `_compile_fuzzy_old_pattern` on pure-ASCII input
+    (to the exact spelling, without separators, unless `fuzzy`).
+
+    Case-insensitive matching also pairs some letters with non-ASCII ones
+    ('s' ~ 'ſ', 'k' ~ 'K' (Kelvin), ...) and the separator class covers
+    non-ASCII whitespace, so this is only exact for ASCII data; `_may_match`
+    handles the rest.
+    Each class is derived from the str pattern itself over the 128 ASCII
+    code points, so the two can never disagree on ASCII text.
+
+    Returns None when some letter has no ASCII spelling at all, i.e. no pure
+    ASCII file can ever match.
+    """
+    ascii_chars = [chr(i) for i in range(128)]
+    sep_chars = [c for c in ascii_chars if re.fullmatch(_SEPARATOR, c)]
+    classes: list[bytes] = []
+    disjoint = True
+    for ch in old_string:
+        one = re.compile(re.escape(ch), flags=re.IGNORECASE)
+        variants = [c for c in ascii_chars if one.fullmatch(c)]
+        if not variants:
+            return None
+        disjoint = disjoint and not set(variants) & set(sep_chars)
+        classes.append(_ascii_class(variants))
+    if not fuzzy:
+        return b"".join(classes)
+    # Possessive separators for the same reason as in `_compile_fuzzy_old_pattern`.
+    sep = _ascii_class(sep_chars) + (b"*+" if disjoint else b"*")
+    return sep.join(classes)
+
+
+def _compile_ascii_prefilter(
+    old_strings: Sequence[str], fuzzy: bool = True
+) -> re.Pattern[bytes] | None:
+    """
+    One bytes regex matching ASCII input that any of `old_strings` could match
+    (None if no pure-ASCII input can match any of them).
+    """
+    sources = [
+        src for old in old_strings if (src := _ascii_prefilter_source(old, fuzzy)) is not None
+    ]
+    if not sources:
+        return None
+    return re.compile(b"|".join(b"(?:" + src + b")" for src in sources))
+
+
+def _may_match(data: bytes, prefilter: re.Pattern[bytes] | None) -> bool:
+    """
+    Cheap byte-level test run before decoding. False means `data` cannot
+    contain a match; True means it has to be decoded and matched for real.
+    """
+    if prefilter is not None and prefilter.search(data):
+        return True
+    return not data.isascii()
+
+
+# Casing of a match, indexing the variants from `_casing_variants`.
+_LOWER = 0
+_UPPER = 1
+_CAPITALIZED = 2
+
+
+def _case_style(matched: str) -> int:
+    """
+    Decide replacement casing based on matched span, ignoring separators,
+    in a single scan:
+
+    - If all cased letters in match are upper -> _UPPER (NEW)
+    - Else if first cased letter is upper -> _CAPITALIZED (New)
+    - Else (or no cased letter at all) -> _LOWER (new)
+    """
+    if matched.islower():
+        return _LOWER
+    upper = False
+    for c in matched:
+        if c.isupper():
+            upper = upper or c.isalpha()
+        elif c.islower() and c.isalpha():
+            return _CAPITALIZED if upper else _LOWER
+    return _UPPER if upper else _LOWER
+
+
+def _casing_variants(new_string: str) -> tuple[str, str, str]:
+    """`new_string` as written for each `_case_style`: new, NEW, New."""
+    if not new_string or not new_string.islower():
+        raise ValueError("new_string must be a non-empty lowercase string")
+    return (
+        new_string.lower(),
+        new_string.upper(),
+        new_string[:1].upper() + new_string[1:].lower(),
+    )
+
+
+class _Replacer:
+    """
+    The `re.subn` callback of a `_Rules`: one instance reused by every call,
+    with `counts` pointed at the caller's tally first.
+    """
+
+    def __init__(self, variants: Sequence[tuple[str, str, str]]) -> None:
+        self.variants = variants
+        self.counts = [0] * len(variants)
+
+    def __call__(self, m: re.Match[str]) -> str:
+        i = (m.lastindex or 1) - 1
+        self.counts[i] += 1
+        return self.variants[i][_case_style(m.group())]
+
+
+def _replace_in_text(text: str, rules: _Rules, counts: list[int] | None = None) -> tuple[str, bool]:
+    """
+    Replace every match of `rules` with the styled new string of the group
+    `i` that matched; when given, `counts[i]` is incremented for each one.
+    """
+    if rules.literals is not None and text.isascii():
+        new_text, n = _replace_literals(text, rules, counts)
+    else:
+        replacer = rules.replacer
+        replacer.counts = counts if counts is not None else [0] * len(rules.variants)
+        new_text, n = rules.pat.subn(replacer, text)
+    return new_text, (n > 0)
+
+
+def _replace_literals(text: str, rules: _Rules, counts: list[int] | None) -> tuple[str, int]:
+    """
+    `_replace_in_text` for strict rules on ASCII `text`, without a regex:
+    every old string is looked up with `str.find` in a lowercased copy (same
+    offsets, as the text is ASCII), taking the leftmost match each time,
+    and the longest on a tie (`rules.literals` is longest first).
+    """
+    literals = rules.literals
+    assert literals is not None
+    folded = text.lower()
+    pieces: list[str] = []
+    pos = n = 0
+    if len(literals) == 1:
+        old, variants, size, find = literals[0], rules.variants[0], len(literals[0]), folded.find
+        start = find(old)
+        while start >= 0:
+            end = start + size
+            pieces.append(text[pos:start])
+            pieces.append(variants[_case_style(text[start:end])])
+            n += 1
+            pos = end
+            start = find(old, pos)
+        if counts is not None:
+            counts[0] += n
+        if not n:
+            return text, 0
+        pieces.append(text[pos:])
+        return "".join(pieces), n
+    found = [folded.find(old) for old in literals]
+    while True:
+        best = -1
+        for i, at in enumerate(found):
+            if at >= 0 and (best < 0 or at < found[best]):
+                best = i
+        if best < 0:
+            break
+        start = found[best]
+        end = start + len(literals[best])
+        pieces.append(text[pos:start])
+        pieces.append(rules.variants[best][_case_style(text[start:end])])
+        if counts is not None:
+            counts[best] += 1
+        n += 1
+        pos = end
+        for i, at in enumerate(found):
+            if 0 <= at < pos:
+                found[i] = folded.find(literals[i], pos)
+    if not n:
+        return text, 0
+    pieces.append(text[pos:])
+    return "".join(pieces), n
+
+
+# (start, end, replacement): byte offsets into the original file, UTF-8 text.
+_Span = tuple[int, int, str]
+
+# (offset, old, new): `new` starts at byte `offset` of the edited file and
+# replaced `old`. Patches of one file are in order, offsets all final.
+_Patch = tuple[int, str, str]
+
+
+def _utf8_len(text: str) -> int:
+    return len(text.encode("utf-8"))
+
+
+def _match_spans(text: str, rules: _Rules, counts: list[int]) -> list[_Span]:
+    """What `_replace_in_text` would replace, as byte spans of `text` encoded."""
+    spans: list[_Span] = []
+    pos = offset = 0
+    for m in rules.pat.finditer(text):
+        i = (m.lastindex or 1) - 1
+        counts[i] += 1
+        offset += _utf8_len(text[pos : m.start()])
+        end = offset + _utf8_len(m.group(0))
+        spans.append((offset, end, rules.variants[i][_case_style(m.group(0))]))
+        pos, offset = m.end(), end
+    return spans
+
+
+def _splice(data: bytes, spans: Sequence[_Span]) -> bytes:
+    """`data` with each of `spans` (in order) replaced."""
+    pieces: list[bytes] = []
+    pos = 0
+    for start, end, replacement in spans:
+        pieces += (data[pos:start], replacement.encode("utf-8"))
+        pos = end
+    pieces.append(data[pos:])
+    return b"".join(pieces)
+
+
+def _undo_patches(
+    spans: Sequence[_Span], old_bytes: Callable[[int, int], bytes]
+) -> tuple[_Patch, ...]:
+    """The patches reverting `spans`, given the original bytes of a span."""
+    patches: list[_Patch] = []
+    shift = 0
+    for start, end, replacement in spans:
+        patches.append((start + shift, old_bytes(start, end).decode("utf-8"), replacement))
+        shift += _utf8_len(replacement) - (end - start)
+    return tuple(patches)
+
+
+@dataclass(frozen=True)
+class _Rules:
+    """
+    Compiled old->new pairs: one combined matcher with one group per pair.
+
+    Groups are ordered longest `old` first (ties keep the mapping order), so
+    at any position the alternation picks the longest spelling: candidates
+    that match at the same start are letter-prefixes of one another, and more
+    letters always span more text. With leftmost scanning that gives
+    leftmost-longest precedence, and each span is replaced exactly once.
+    """
+
+    pairs: tuple[tuple[str, str], ...]
+    pat: re.Pattern[str]
+    prefilter: re.Pattern[bytes] | None
+    # All indexed by group number - 1.
+    new_strings: tuple[str, ...]
+    pair_index: tuple[int, ...]
+    # (new, NEW, New) for each group, by `_case_style`.
+    variants: tuple[tuple[str, str, str], ...]
+    replacer: _Replacer = field(compare=False)
+    # Strict rules only: the old strings, for `_replace_literals`.
+    literals: tuple[str, ...] | None = None
+    # `pat` for ASCII bytes, same groups and same matches; None unless all
+    # old strings are ASCII.
+    byte_pat: re.Pattern[bytes] | None = None
+
+    @property
+    def max_old_len(self) -> int:
+        return max(len(old) for old, _ in self.pairs)
+
+    def pair_counts(self, counts: Sequence[int]) -> dict[str, int]:
+        by_pair = [0] * len(self.pairs)
+        for slot, n in enumerate(counts):
+            by_pair[self.pair_index[slot]] += n
+        return {f"{old}->{new}": n for (old, new), n in zip(self.pairs, by_pair)}
+
+
+def _compile_rules(pairs: Sequence[tuple[str, str]], strict: bool = False) -> _Rules:
+    """
+    With `strict`, each old string only matches its exact spelling (any
+    case), not with separators between its letters.
+    """
+    if not pairs:
+        raise ValueError("at least one old->new pair is required")
+    olds = [old for old, _ in pairs]
+    if len(set(olds)) != len(olds):
+        raise ValueError("each old string may only appear once")
+    variants = tuple(_casing_variants(new) for _, new in pairs)
+
+    order = sorted(range(len(pairs)), key=lambda i: -len(pairs[i][0]))
+    # Compiled even when strict, as it validates the old strings.
+    alternatives = [_compile_fuzzy_old_pattern(pairs[i][0]).pattern for i in order]
+    if strict:
+        alternatives = [re.escape(pairs[i][0]) for i in order]
+    ordered = tuple(variants[i] for i in order)
+    source = "|".join(f"({alt})" for alt in alternatives)
+    byte_pat = None
+    if source.isascii():
+        byte_source = source.replace(_SEPARATOR, _ASCII_SEPARATOR).encode("ascii")
+        byte_pat = re.compile(byte_source, flags=re.IGNORECASE)
+    return _Rules(
+        pairs=tuple(pairs),
+        pat=re.compile(source, flags=re.IGNORECASE),
+        prefilter=_compile_ascii_prefilter(olds, fuzzy=not strict),
+        new_strings=tuple(pairs[i][1] for i in order),
+        pair_index=tuple(order),
+        variants=ordered,
+        replacer=_Replacer(ordered),
+        literals=tuple(pairs[i][0] for i in order) if strict else None,
+        byte_pat=byte_pat,
+    )
+
+
+def load_mapping(path: Path) -> list[tuple[str, str]]:
+    """
+    Read `old<TAB>new` pairs, one per line. Blank lines and lines starting
+    with '#' are ignored.
+    """
+    pairs: list[tuple[str, str]] = []
+    for lineno, line in enumerate(path.read_text(encoding="utf-8").splitlines(), start=1):
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        fields = line.split("\t")
+        if len(fields) != 2:
+            raise ValueError(f"{path}:{lineno}: expected 'old<TAB>new', got {line!r}")
+        pairs.append((fields[0], fields[1]))
+    return pairs
+
+
+def _decode_utf8_text(data: bytes) -> str | None:
+    # A UTF-8 BOM decodes to U+FEFF and is written back untouched, as are
+    # line endings: only matched spans ever change.
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+def _stream_may_match(
+    src: BinaryIO, prefilter: re.Pattern[bytes] | None, chunk_size: int, overlap: int
+) -> bool:
+    """
+    `_may_match` over a file read in chunks, keeping `overlap` bytes between
+    consecutive chunks so byte-level matches across a boundary are not lost.
+    """
+    tail = b""
+    while chunk := src.read(chunk_size):
+        if not chunk.isascii():
+            return True
+        buf = tail + chunk
+        if prefilter is not None and prefilter.search(buf):
+            return True
+        tail = buf[-overlap:]
+    return False
+
+
+def _stream_replace(
+    src: BinaryIO,
+    write: Callable[[str], object],
+    rules: _Rules,
+    counts: list[int],
+    chunk_size: int,
+    max_match_len: int,
+    spans: list[_Span] | None = None,
+) -> int:
+    """
+    Incrementally decode `src`, replace matches and pass the output to `write`.
+
+    Only the last `max_match_len` characters of each window are carried over
+    to the next one: matches starting before that point are final, because
+    any match up to `max_match_len` long is entirely inside the window.
+    Raises UnicodeDecodeError on invalid UTF-8. Returns the number of matches
+    (also tallied per group in `counts`, and appended to `spans` if given).
+    """
+    pat = rules.pat
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    carry = ""
+    count = 0
+    # Byte offset of `text[pos]` in the original file, tracked only for `spans`.
+    offset = 0
+    while True:
+        raw = src.read(chunk_size)
+        text = carry + decoder.decode(raw, final=not raw)
+        limit = len(text) if not raw else max(0, len(text) - max_match_len)
+
+        pos = 0
+        pieces: list[str] = []
+        for m in pat.finditer(text):
+            if m.start() >= limit:
+                break
+            pieces.append(text[pos : m.start()])
+            i = (m.lastindex or 1) - 1
+            replacement = rules.variants[i][_case_style(m.group(0))]
+            pieces.append(replacement)
+            if spans is not None:
+                offset += _utf8_len(text[pos : m.start()])
+                end = offset + _utf8_len(m.group(0))
+                spans.append((offset, end, replacement))
+                offset = end
+            pos = m.end()
+            counts[i] += 1
+            count += 1
+
+        if not raw:
+            pieces.append(text[pos:])
+            write("".join(pieces))
+            return count
+
+        cut = max(pos, limit)
+        pieces.append(text[pos:cut])
+        write("".join(pieces))
+        if spans is not None:
+            offset += _utf8_len(text[pos:cut])
+        carry = text[cut:]
+
+
+# Outcomes of the per-file content phase.
+_EDITED = "edited"
+_UNCHANGED = "unchanged"
+_SKIPPED = "skipped"
+_SYMLINK = "symlink"
+_REJECTED = "rejected"
+
+# Why a file was skipped (`Stats.skipped_files` keys). Policy skips depend on
+# the options rather than the bytes.
+_SKIP_EXTENSION = "extension"
+_SKIP_SIZE = "size"
+_SKIP_BINARY = "binary"
+_SKIP_NONUTF8 = "nonutf8"
+_SKIP_UNREADABLE = "unreadable"
+_POLICY_SKIPS = (_SKIP_EXTENSION, _SKIP_SIZE)
+# Skips that say nothing about the bytes (policies, and files that could not
+# be read, maybe only this once): never recorded as clean by the manifest or
+# the git clean-blob cache.
+_UNSCANNED_SKIPS = (*_POLICY_SKIPS, _SKIP_UNREADABLE)
+
+
+@dataclass(frozen=True, slots=True)
+class _FileResult:
+    outcome: str
+    size: int = 0
+    streamed: bool = False
+    # Matches per `_Rules` group, only for edited files.
+    counts: tuple[int, ...] = ()
+    syscalls: dict[str, int] = field(default_factory=dict[str, int])
+    # Planning only (`_ContentJob.plan`): digest of the original bytes and
+    # the byte spans to replace in them.
+    sha256: str = ""
+    spans: tuple[_Span, ...] = ()
+    # Seconds per step (see `Stats.phase_seconds`), "bytes_read", "bytes_written".
+    metrics: dict[str, float] = field(default_factory=dict[str, float])
+    # Output-dir runs only: how the file reached its destination (a
+    # `Stats.output_files` key).
+    placed: str = ""
+    # Skipped files only: why (a `Stats.skipped_files` key).
+    reason: str = ""
+
+
+def _count(syscalls: dict[str, int], name: str, n: int = 1) -> None:
+    syscalls[name] = syscalls.get(name, 0) + n
+
+
+def _add(metrics: dict[str, float], name: str, value: float) -> None:
+    metrics[name] = metrics.get(name, 0.0) + value
+
+
+# Gets an edited file, the digest of its new contents and the patches that
+# revert them, right before the file is overwritten or replaced.
+_EditHook = Callable[[Path, str, tuple[_Patch, ...]], object]
+
+
+@dataclass(frozen=True)
+class _ContentJob:
+    """
+    Everything the content phase needs to rewrite one file.
+
+    Kept small and picklable so it can be shipped once to each pool worker.
+    """
+
+    rules: _Rules
+    dry_run: bool
+    stream_threshold: int = DEFAULT_STREAM_THRESHOLD
+    max_match_len: int = DEFAULT_MAX_MATCH_LEN
+    # Record digests and spans of edited files instead of writing them.
+    plan: bool = False
+    # Output-dir runs only: how unedited files get there (see `_place_file`).
+    link_mode: str = "hardlink"
+    # Shipped empty to each worker, which then fills its own copy.
+    dedup: _DedupCache | None = None
+    # Skip policies (see `_policy_skip`) and the head sniffed before reading.
+    include_ext: frozenset[str] = frozenset()
+    exclude_ext: frozenset[str] = frozenset()
+    max_size: int = 0
+    sniff_bytes: int = DEFAULT_SNIFF_BYTES
+    mmap_threshold: int = DEFAULT_MMAP_THRESHOLD
+    # In-process runs only (not picklable): journals each edit before it is made.
+    journal: _EditHook | None = None
+
+
+def _normalize_ext(ext: str) -> str:
+    """ "PY", "py" and ".py" all become ".py", as `Path.suffix.lower()` gives."""
+    ext = ext.strip().lower()
+    return ext if not ext or ext.startswith(".") else "." + ext
+
+
+def _policy_skip(fpath: Path, job: _ContentJob) -> bool:
+    """Whether the extension policies leave `fpath`'s contents alone."""
+    if not (job.include_ext or job.exclude_ext):
+        return False
+    ext = fpath.suffix.lower()
+    return ext in job.exclude_ext or bool(job.include_ext) and ext not in job.include_ext
+
+
+def _sniff(head: bytes) -> str:
+    """Skip reason for a file starting with `head`, or "" if it may be UTF-8 text."""
+    if b"\0" in head:
+        return _SKIP_BINARY
+    if not head.isascii():
+        try:
+            # Not final: a character cut off at the end of `head` is fine.
+            codecs.getincrementaldecoder("utf-8")().decode(head)
+        except UnicodeDecodeError:
+            return _SKIP_NONUTF8
+    return ""
+
+
+@dataclass(frozen=True, slots=True)
+class _Cached:
+    """What the content phase made of some bytes, whichever file held them."""
+
+    outcome: str
+    counts: tuple[int, ...] = ()
+    # Edited, when writing: the new contents.
+    data: bytes = b""
+    # Edited, when planning or journaling: as in `_FileResult`.
+    sha256: str = ""
+    spans: tuple[_Span, ...] = ()
+    # Skipped: as in `_FileResult`.
+    reason: str = ""
+    undo: tuple[_Patch, ...] = ()
+
+
+# Rewritten bytes kept by one dedup cache; past this, edits are not cached.
+_DEDUP_MAX_BYTES = 256 * 1024 * 1024
+
+
+class _DedupCache:
+    """Content-phase results of one run, keyed by a hash of the raw bytes."""
+
+    def __init__(self, max_bytes: int = _DEDUP_MAX_BYTES) -> None:
+        self.entries: dict[bytes, _Cached] = {}
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    @staticmethod
+    def key(data: bytes) -> bytes:
+        # Faster than BLAKE2 where the CPU has SHA extensions, and planning
+        # needs this very digest anyway.
+        return hashlib.sha256(data).digest()
+
+    def get(self, key: bytes) -> _Cached | None:
+        return self.entries.get(key)
+
+    def put(self, key: bytes, entry: _Cached) -> None:
+        if self.bytes + len(entry.data) > self.max_bytes:
+            return
+        self.bytes += len(entry.data)
+        self.entries[key] = entry
+
+
+def _rewrite_large_file(
+    fpath: Path,
+    src: io.BufferedReader,
+    st: os.stat_result,
+    job: _ContentJob,
+    syscalls: dict[str, int],
+    metrics: dict[str, float],
+    dest: Path | None = None,
+) -> _FileResult:
+    """
+    Constant-memory variant of `_rewrite_file` for big files, given `src`
+    already open for reading.
+
+    The output goes to a temp file next to the original (or `dest`), which
+    then atomically replaces it (keeping the permission bits).
+    """
+    size = st.st_size
+    target = fpath if dest is None else dest
+    try:
+        may_match = _stream_may_match(
+            src, job.rules.prefilter, _STREAM_CHUNK_SIZE, job.max_match_len
+        )
+        _add(metrics, "bytes_read", src.tell())
+        if not may_match:
+            return _FileResult(_REJECTED, size, streamed=True, syscalls=syscalls, metrics=metrics)
+        src.seek(0)
+
+        counts = [0] * len(job.rules.new_strings)
+        if job.dry_run or job.plan:
+            spans: list[_Span] | None = [] if job.plan else None
+            n = _stream_replace(
+                src, lambda _: None, job.rules, counts, _STREAM_CHUNK_SIZE, job.max_match_len, spans
+            )
+            _add(metrics, "bytes_read", src.tell())
+            if not n:
+                return _FileResult(
+                    _UNCHANGED, size, streamed=True, syscalls=syscalls, metrics=metrics
+                )
+            sha256 = ""
+            if spans is not None:
+                src.seek(0)
+                sha256 = hashlib.file_digest(src, "sha256").hexdigest()
+                _add(metrics, "bytes_read", src.tell())
+            return _FileResult(
+                _EDITED,
+                size,
+                streamed=True,
+                counts=tuple(counts),
+                syscalls=syscalls,
+                metrics=metrics,
+                sha256=sha256,
+                spans=tuple(spans or ()),
+            )
+
+        fd, tmp_name = tempfile.mkstemp(
+            dir=target.parent, prefix=f".{target.name}.", suffix=".switcheroo"
+        )
+        _count(syscalls, "open")
+        tmp = Path(tmp_name)
+        spans = [] if job.journal is not None else None
+        digest = hashlib.sha256() if job.journal is not None else None
+        try:
+            with open(fd, "wb") as dst:
+
+                def write(text: str) -> None:
+                    out = text.encode("utf-8")
+                    dst.write(out)
+                    if digest is not None:
+                        digest.update(out)
+
+                n = _stream_replace(
+                    src, write, job.rules, counts, _STREAM_CHUNK_SIZE, job.max_match_len, spans
+                )
+                _add(metrics, "bytes_read", src.tell())
+                if n:
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                    _add(metrics, "bytes_written", dst.tell())
+            if not n:
+                _count(syscalls, "unlink")
+                tmp.unlink()
+                return _FileResult(
+                    _UNCHANGED, size, streamed=True, syscalls=syscalls, metrics=metrics
+                )
+            if job.journal is not None and spans is not None and digest is not None:
+
+                def old_bytes(start: int, end: int) -> bytes:
+                    src.seek(start)
+                    return src.read(end - start)
+
+                job.journal(fpath, digest.hexdigest(), _undo_patches(spans, old_bytes))
+            _count(syscalls, "chmod")
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            _count(syscalls, "rename")
+            os.replace(tmp, target)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+    except UnicodeDecodeError:
+        return _FileResult(
+            _SKIPPED,
+            size,
+            streamed=True,
+            syscalls=syscalls,
+            metrics=metrics,
+            reason=_SKIP_NONUTF8,
+        )
+    except OSError:
+        return _FileResult(_SKIPPED, syscalls=syscalls, metrics=metrics, reason=_SKIP_UNREADABLE)
+    return _FileResult(
+        _EDITED,
+        size,
+        streamed=True,
+        counts=tuple(counts),
+        syscalls=syscalls,
+        metrics=metrics,
+    )
+
+
+def _writev_all(fd: int, buffers: list[bytes | memoryview], syscalls: dict[str, int]) -> int:
+    """Write all of `buffers`, in order, with as few `os.writev` calls as it takes."""
+    total = 0
+    start = 0
+    while start < len(buffers):
+        batch = buffers[start : start + _IOV_MAX]
+        if hasattr(os, "writev"):
+            _count(syscalls, "writev")
+            n = os.writev(fd, batch)
+        else:  # Windows
+            _count(syscalls, "write")
+            n = os.write(fd, batch[0])
+        total += n
+        # Drop what was written; a buffer written in part is resumed.
+        while start < len(buffers) and n >= len(buffers[start]):
+            n -= len(buffers[start])
+            start += 1
+        if n:
+            buffers[start] = memoryview(buffers[start])[n:]
+    return total
+
+
+def _sha256_hex(buffers: Iterable[bytes | memoryview]) -> str:
+    """Hex SHA-256 of `buffers` joined, without joining them."""
+    digest = hashlib.sha256()
+    for buf in buffers:
+        digest.update(buf)
+    return digest.hexdigest()
+
+
+def _rewrite_mapped_file(
+    fpath: Path,
+    src: BinaryIO,
+    st: os.stat_result,
+    job: _ContentJob,
+    syscalls: dict[str, int],
+    metrics: dict[str, float],
+    dest: Path | None = None,
+) -> _FileResult | bytes:
+    """
+    `_rewrite_file` for an ASCII file, without decoding or copying it: the
+    matches are found on a memory map of `src` (with `_Rules.byte_pat`) and
+    the output is written as slices of the map around the encoded
+    replacements, to a temp file that then replaces the original (keeping
+    only its permission bits) or goes to `dest`. `job.dedup` is not used.
+
+    The old strings must be ASCII (`_Rules.byte_pat` set). A file that turns
+    out not to be is returned as its bytes, copied out of the map, rather
+    than read a second time.
+    """
+    rules = job.rules
+    assert rules.byte_pat is not None
+    started = time.perf_counter()
+    size = st.st_size
+    _count(syscalls, "mmap")
+    with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(0, size, _STREAM_CHUNK_SIZE):
+            if not mm[i : i + _STREAM_CHUNK_SIZE].isascii():
+                return mm[:]
+        metrics["bytes_read"] = size
+        may_match = rules.prefilter is not None and rules.prefilter.search(mm)
+        decoded = time.perf_counter()
+        metrics["decode"] = decoded - started
+        if not may_match:
+            return _FileResult(_REJECTED, size, syscalls=syscalls, metrics=metrics)
+
+        counts = [0] * len(rules.new_strings)
+        spans: list[_Span] = []
+        for m in rules.byte_pat.finditer(mm):
+            i = (m.lastindex or 1) - 1
+            counts[i] += 1
+            spans.append((m.start(), m.end(), rules.variants[i][_case_style(m[0].decode())]))
+        matched = time.perf_counter()
+        metrics["match"] = matched - decoded
+        if not spans:
+            return _FileResult(_UNCHANGED, size, syscalls=syscalls, metrics=metrics)
+        if job.dry_run or job.plan:
+            return _FileResult(
+                _EDITED,
+                size,
+                counts=tuple(counts),
+                syscalls=syscalls,
+                metrics=metrics,
+                sha256=hashlib.sha256(mm).hexdigest() if job.plan else "",
+                spans=tuple(spans) if job.plan else (),
+            )
+
+        target = fpath if dest is None else dest
+        view = memoryview(mm)
+        buffers: list[bytes | memoryview] = []
+        try:
+            pos = touched = 0
+            for start, end, replacement in spans:
+                if start > pos:
+                    buffers.append(view[pos:start])
+                if replacement:
+                    buffers.append(replacement.encode("utf-8"))
+                touched += end - start
+                pos = end
+            if pos < size:
+                buffers.append(view[pos:])
+            # Hashed before writing: `_writev_all` trims the buffers it wrote.
+            digest = _sha256_hex(buffers) if job.journal is not None else ""
+            fd, tmp_name = tempfile.mkstemp(
+                dir=target.parent, prefix=f".{target.name}.", suffix=".switcheroo"
+            )
+            _count(syscalls, "open")
+            tmp = Path(tmp_name)
+            try:
+                with open(fd, "wb") as dst:
+                    written = _writev_all(dst.fileno(), buffers, syscalls)
+                    os.fsync(dst.fileno())
+                if job.journal is not None:
+                    undo = _undo_patches(spans, lambda start, end: mm[start:end])
+                    job.journal(fpath, digest, undo)
+                _count(syscalls, "chmod")
+                os.chmod(tmp, stat.S_IMODE(st.st_mode))
+                _count(syscalls, "rename")
+                os.replace(tmp, target)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+        finally:
+            # The map cannot close while slices of it are alive.
+            buffers.clear()
+            view.release()
+    metrics["write"] = time.perf_counter() - matched
+    metrics["bytes_written"] = written
+    metrics["mmap_files"] = 1
+    metrics["mmap_bytes_copied"] = size - touched
+    metrics["mmap_bytes_touched"] = touched
+    return _FileResult(
+        _EDITED,
+        size,
+        counts=tuple(counts),
+        syscalls=syscalls,
+        metrics=metrics,
+    )
+
+
+# Never follow a symlink swapped in after the walk, never block on a FIFO.
+_OPEN_FLAGS = os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0) | getattr(os, "O_NONBLOCK", 0)
+
+
+def _write_contents(
+    fpath: Path, dest: Path | None, data: bytes, mode: int, syscalls: dict[str, int]
+) -> int:
+    """Write `data` over `fpath`, or to `dest` with `fpath`'s permission bits."""
+    _count(syscalls, "open")
+    if dest is None:
+        return fpath.write_bytes(data)
+    n = dest.write_bytes(data)
+    _count(syscalls, "chmod")
+    os.chmod(dest, stat.S_IMODE(mode))
+    return n
+
+
+@dataclass(slots=True)
+class _Loaded:
+    """A file read whole by `_load_file`, ready to be matched."""
+
+    data: bytes
+    mode: int
+    syscalls: dict[str, int]
+    metrics: dict[str, float]
+
+
+def _load_file(
+    fpath: Path, job: _ContentJob, dest: Path | None = None, stream: bool = True
+) -> _FileResult | _Loaded | None:
+    """
+    The reading half of `_rewrite_file`: policies -> open -> sniff -> read.
+
+    Returns the result of files settled on the way (skipped ones, and those
+    large enough to be streamed or mapped, which are rewritten right here),
+    or their bytes. Without `stream`, those large files are left alone: None.
+    """
+    if _policy_skip(fpath, job):
+        return _FileResult(_SKIPPED, reason=_SKIP_EXTENSION)
+    started = time.perf_counter()
+    syscalls = {"open": 1}
+    metrics: dict[str, float] = {}
+    try:
+        fd = os.open(fpath, _OPEN_FLAGS)
+    except OSError as e:
+        if e.errno == errno.ELOOP:
+            return _FileResult(_SYMLINK, syscalls=syscalls, metrics=metrics)
+        return _FileResult(_SKIPPED, syscalls=syscalls, metrics=metrics, reason=_SKIP_UNREADABLE)
+
+    sniff = job.sniff_bytes
+    head = b""
+    with open(fd, "rb") as src:
+        _count(syscalls, "stat")
+        try:
+            st = os.fstat(fd)
+            if job.max_size and st.st_size > job.max_size:
+                return _FileResult(_SKIPPED, syscalls=syscalls, metrics=metrics, reason=_SKIP_SIZE)
+            # Streamed and mapped files are never read whole: sniff those
+            # even when they are no longer than `sniff`.
+            large = st.st_size >= job.stream_threshold or (
+                job.mmap_threshold and st.st_size >= job.mmap_threshold
+            )
+            if sniff and (st.st_size > sniff or large):
+                head = src.read(sniff)
+                reason = _sniff(head)
+                if reason:
+                    metrics["read"] = time.perf_counter() - started
+                    metrics["bytes_read"] = len(head)
+                    return _FileResult(
+                        _SKIPPED, st.st_size, syscalls=syscalls, metrics=metrics, reason=reason
+                    )
+                src.seek(0)
+            if st.st_size >= job.stream_threshold:
+                if not stream:
+                    return None
+                result = _rewrite_large_file(fpath, src, st, job, syscalls, metrics, dest)
+                metrics["stream"] = time.perf_counter() - started
+                return result
+            # Not mapped when the head already shows the file is not ASCII.
+            if (
+                job.mmap_threshold
+                and st.st_size >= job.mmap_threshold
+                and job.rules.byte_pat is not None
+                and head.isascii()
+            ):
+                if not stream:
+                    return None
+                mapped = _rewrite_mapped_file(fpath, src, st, job, syscalls, metrics, dest)
+                if isinstance(mapped, _FileResult):
+                    return mapped
+                data = mapped
+            else:
+                data = src.read()
+        except OSError:
+            return _FileResult(
+                _SKIPPED, syscalls=syscalls, metrics=metrics, reason=_SKIP_UNREADABLE
+            )
+    metrics["read"] = time.perf_counter() - started
+    metrics["bytes_read"] = len(data)
+
+    # Smaller files were read whole: check the same head, after the fact.
+    if sniff and data.find(b"\0", 0, sniff) >= 0:
+        return _FileResult(
+            _SKIPPED, len(data), syscalls=syscalls, metrics=metrics, reason=_SKIP_BINARY
+        )
+    return _Loaded(data, st.st_mode, syscalls, metrics)
+
+
+def _rewrite_file(
+    fpath: Path, job: _ContentJob, dest: Path | None = None, loaded: _Loaded | None = None
+) -> _FileResult:
+    """
+    Policies -> read -> prefilter -> decode -> replace -> write a single file.
+
+    The walker already knows `fpath` is a regular file, so this costs one
+    open and one fstat (plus an open to write it back when edited); files
+    the extension policies skip are not even opened, and files larger than
+    `job.sniff_bytes` are only read past their head if it looks like text.
+    With `dest`, the edited bytes go there instead and `fpath` is left alone.
+    With `job.dedup`, bytes seen before skip straight to the write. With
+    `loaded` (see `_load_file`), the file was already read.
+    """
+    if loaded is None:
+        result = _load_file(fpath, job, dest)
+        assert result is not None
+        if isinstance(result, _FileResult):
+            return result
+        loaded = result
+    data, mode, syscalls, metrics = loaded.data, loaded.mode, loaded.syscalls, loaded.metrics
+    read = time.perf_counter()
+
+    if not _may_match(data, job.rules.prefilter):
+        metrics["decode"] = time.perf_counter() - read
+        return _FileResult(_REJECTED, len(data), syscalls=syscalls, metrics=metrics)
+
+    cache = job.dedup
+    key = b""
+    if cache is not None:
+        key = cache.key(data)
+        entry = cache.get(key)
+        hashed = time.perf_counter()
+        metrics["hash"] = hashed - read
+        if entry is not None:
+            metrics["dedup_hits"] = 1
+            if entry.outcome == _EDITED and not (job.dry_run or job.plan):
+                if job.journal is not None:
+                    job.journal(fpath, entry.sha256, entry.undo)
+                metrics["bytes_written"] = _write_contents(fpath, dest, entry.data, mode, syscalls)
+                metrics["write"] = time.perf_counter() - hashed
+            return _FileResult(
+                entry.outcome,
+                len(data),
+                counts=entry.counts,
+                syscalls=syscalls,
+                metrics=metrics,
+                sha256=entry.sha256,
+                spans=entry.spans,
+                reason=entry.reason,
+            )
+        metrics["dedup_misses"] = 1
+        read = hashed
+
+    text = _decode_utf8_text(data)
+    decoded = time.perf_counter()
+    metrics["decode"] = decoded - read
+    if text is None:
+        if cache is not None:
+            cache.put(key, _Cached(_SKIPPED, reason=_SKIP_NONUTF8))
+        return _FileResult(
+            _SKIPPED, len(data), syscalls=syscalls, metrics=metrics, reason=_SKIP_NONUTF8
+        )
+
+    counts = [0] * len(job.rules.new_strings)
+    if job.plan:
+        spans = _match_spans(text, job.rules, counts)
+        metrics["match"] = time.perf_counter() - decoded
+        if not spans:
+            if cache is not None:
+                cache.put(key, _Cached(_UNCHANGED))
+            return _FileResult(_UNCHANGED, len(data), syscalls=syscalls, metrics=metrics)
+        digest = key.hex() if cache is not None else hashlib.sha256(data).hexdigest()
+        if cache is not None:
+            cache.put(key, _Cached(_EDITED, tuple(counts), sha256=digest, spans=tuple(spans)))
+        return _FileResult(
+            _EDITED,
+            len(data),
+            counts=tuple(counts),
+            syscalls=syscalls,
+            metrics=metrics,
+            sha256=digest,
+            spans=tuple(spans),
+        )
+
+    spans: list[_Span] = []
+    new_text = ""
+    if job.journal is not None:
+        # Spliced from the spans rather than replaced, to know what went where.
+        spans = _match_spans(text, job.rules, counts)
+        changed = bool(spans)
+    else:
+        new_text, changed = _replace_in_text(text, job.rules, counts)
+    matched = time.perf_counter()
+    metrics["match"] = matched - decoded
+    if not changed:
+        if cache is not None:
+            cache.put(key, _Cached(_UNCHANGED))
+        return _FileResult(_UNCHANGED, len(data), syscalls=syscalls, metrics=metrics)
+
+    digest = ""
+    undo: tuple[_Patch, ...] = ()
+    if job.journal is not None:
+        new_data = _splice(data, spans)
+        digest = hashlib.sha256(new_data).hexdigest()
+        undo = _undo_patches(spans, lambda start, end: data[start:end])
+    else:
+        new_data = b"" if job.dry_run else new_text.encode("utf-8")
+    if cache is not None:
+        cache.put(key, _Cached(_EDITED, tuple(counts), new_data, sha256=digest, undo=undo))
+    if not job.dry_run:
+        if job.journal is not None:
+            job.journal(fpath, digest, undo)
+        metrics["bytes_written"] = _write_contents(fpath, dest, new_data, mode, syscalls)
+        metrics["write"] = time.perf_counter() - matched
+    return _FileResult(_EDITED, len(data), counts=tuple(counts), syscalls=syscalls, metrics=metrics)
+
+
+# How `--output-dir` gets files it does not edit; all fall back to a copy.
+_LINK_MODES = ("hardlink", "reflink", "copy")
+
+# Linux ioctl sharing one file's extents with another (btrfs, XFS, ...).
+_FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dst: Path) -> None:
+    """Create `dst` as a copy-on-write clone of `src`; OSError if unsupported."""
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported", str(dst)) from None
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+
+
+def _place_file(src: Path, dst: Path, link_mode: str, syscalls: dict[str, int]) -> str:
+    """
+    Make `dst` hold the bytes of `src` as cheaply as `link_mode` allows,
+    falling back to a plain copy. Returns how (a `Stats.output_files` key).
+    """
+    try:
+        if link_mode == "hardlink":
+            _count(syscalls, "link")
+            os.link(src, dst, follow_symlinks=False)
+            return "hardlink"
+        if link_mode == "reflink":
+            _count(syscalls, "open", 2)
+            _reflink(src, dst)
+            _count(syscalls, "chmod")
+            shutil.copystat(src, dst)
+            return "reflink"
+    except OSError:
+        pass
+    _count(syscalls, "copy")
+    try:
+        shutil.copy2(src, dst, follow_symlinks=False)
+    except OSError:
+        return "failed"
+    return "copy"
+
+
+def _output_file(
+    fpath: Path, dest: Path, job: _ContentJob, loaded: _Loaded | None = None
+) -> _FileResult:
+    """
+    `_rewrite_file` into `dest`; a file it does not edit is linked there
+    instead, so only edited files are ever written.
+    """
+    result = _rewrite_file(fpath, job, dest, loaded)
+    if job.dry_run or result.outcome == _SYMLINK:
+        return result
+    if result.outcome == _EDITED:
+        return dataclasses.replace(result, placed="written")
+    placed = _place_file(fpath, dest, job.link_mode, result.syscalls)
+    return dataclasses.replace(result, placed=placed)
+
+
+_worker_job: _ContentJob | None = None
+
+
+def _init_worker(job: _ContentJob) -> None:
+    global _worker_job
+    _worker_job = job
+
+
+def _rewrite_file_in_worker(fpath: Path) -> _FileResult:
+    assert _worker_job is not None
+    return _rewrite_file(fpath, _worker_job)
+
+
+def _output_file_in_worker(fpath: Path, dest: Path) -> _FileResult:
+    assert _worker_job is not None
+    return _output_file(fpath, dest, _worker_job)
+
+
+def _resolve_jobs(jobs: int) -> int:
+    """`jobs <= 0` means one worker per CPU."""
+    if jobs > 0:
+        return jobs
+    return os.cpu_count() or 1
+
+
+def _iter_prefetched(
+    paths: Sequence[Path],
+    job: _ContentJob,
+    threads: int,
+    depth: int,
+    dests: Sequence[Path] | None = None,
+) -> Iterator[_FileResult]:
+    """
+    `_iter_content_outcomes` for one process, with `threads` threads reading
+    ahead of it (`_load_file`), in order.
+
+    At most `depth` files are read but not yet matched: the next read is only
+    queued once a file is taken off, so memory stays under `depth` files
+    below the mmap threshold. Files to be streamed or mapped are read where
+    they are rewritten, in this thread. Time spent waiting on a read is "wait".
+    """
+    pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="switcheroo-prefetch")
+    try:
+        ahead: deque[Future[_FileResult | _Loaded | None]] = deque()
+        for fpath in paths[:depth]:
+            ahead.append(pool.submit(_load_file, fpath, job, None, False))
+        for k, fpath in enumerate(paths):
+            waited = time.perf_counter()
+            loaded = ahead.popleft().result()
+            waited = time.perf_counter() - waited
+            if k + depth < len(paths):
+                ahead.append(pool.submit(_load_file, paths[k + depth], job, None, False))
+            if isinstance(loaded, _FileResult):
+                result = loaded
+                if dests is not None and result.outcome != _SYMLINK and not job.dry_run:
+                    placed = _place_file(fpath, dests[k], job.link_mode, result.syscalls)
+                    result = dataclasses.replace(result, placed=placed)
+            elif dests is None:
+                result = _rewrite_file(fpath, job, None, loaded)
+            else:
+                result = _output_file(fpath, dests[k], job, loaded)
+            _add(result.metrics, "wait", waited)
+            yield result
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def _iter_content_outcomes(
+    paths: Sequence[Path],
+    job: _ContentJob,
+    jobs: int,
+    dests: Sequence[Path] | None = None,
+    prefetch: int = 0,
+    prefetch_depth: int = 0,
+) -> Iterator[_FileResult]:
+    """
+    Yield the content-phase outcome of every path, in the order given.
+
+    With `jobs == 1` files are processed in-process (read ahead by `prefetch`
+    threads, up to `prefetch_depth` files, if set); otherwise they are fanned
+    out to a process pool. Each file is independent and `Executor.map` keeps
+    input order, so all paths produce the same outcomes and the same bytes.
+    With `dests`, each path goes to its destination instead (`_output_file`).
+    """
+    if prefetch and jobs == 1 and len(paths) > 1:
+        yield from _iter_prefetched(paths, job, prefetch, prefetch_depth or 4 * prefetch, dests)
+        return
+    if jobs == 1 or len(paths) < 2:
+        for k, fpath in enumerate(paths):
+            if dests is None:
+                yield _rewrite_file(fpath, job)
+            else:
+                yield _output_file(fpath, dests[k], job)
+        return
+
+    # Big enough chunks to amortise IPC, small enough to keep workers balanced.
+    chunksize = max(1, min(256, len(paths) // (jobs * 8)))
+    pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(job,))
+    try:
+        if dests is None:
+            yield from pool.map(_rewrite_file_in_worker, paths, chunksize=chunksize)
+        else:
+            yield from pool.map(_output_file_in_worker, paths, dests, chunksize=chunksize)
+    finally:
+        # Closed early (the consumer stopped): drop the chunks not started yet.
+        pool.shutdown(cancel_futures=True)
+
+
+@dataclass(slots=True)
+class _DirListing:
+    """
+    One directory as seen by a single `os.scandir` call.
+
+    Symlinks are left out of `files`/`dirs` (never edited nor renamed; they
+    are in `links`) but stay in `names`, which is kept current across renames
+    so collision checks need no `exists()` call.
+    """
+
+    path: Path
+    files: list[str]
+    dirs: list[str]
+    # Subset of `files` that are regular files, i.e. candidates for editing.
+    regular: list[str]
+    names: set[str]
+    # (inode, size, mtime_ns) of each `regular` file, when requested.
+    sigs: list[_FileSig] | None = None
+    # False when `names` only holds what the git index knows about, so a
+    # rename target may still exist on disk.
+    complete: bool = True
+    links: list[str] = field(default_factory=list[str])
+    _folded: Counter[str] | None = None
+
+    def taken(self, old: str, new: str, case_insensitive: bool) -> bool:
+        """Would renaming `old` -> `new` clobber a sibling?"""
+        if new in self.names:
+            return True
+        if not case_insensitive:
+            return False
+        if self._folded is None:
+            self._folded = Counter(n.casefold() for n in self.names)
+        folded = new.casefold()
+        return self._folded[folded] - (folded == old.casefold()) > 0
+
+    def moved(self, old: str, new: str) -> None:
+        self.names.discard(old)
+        self.names.add(new)
+        if self._folded is not None:
+            self._folded[old.casefold()] -= 1
+            self._folded[new.casefold()] += 1
+
+
+_FileSig = tuple[int, int, int]
+
+
+def _scan_dir(path: Path, syscalls: dict[str, int], with_sigs: bool = False) -> _DirListing | None:
+    """
+    List `path` with one `os.scandir`. Entry types come from the cached
+    `DirEntry` data (d_type on most filesystems), so no per-entry lstat;
+    `with_sigs` adds one lstat per regular file for its `_FileSig`.
+    """
+    files: list[str] = []
+    dirs: list[str] = []
+    regular: list[str] = []
+    sigs: list[_FileSig] = []
+    links: list[str] = []
+    names: set[str] = set()
+    _count(syscalls, "scandir")
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                names.add(entry.name)
+                try:
+                    if entry.is_symlink():
+                        links.append(entry.name)
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                        continue
+                    files.append(entry.name)
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    if with_sigs:
+                        _count(syscalls, "stat")
+                        st = entry.stat(follow_symlinks=False)
+                        sigs.append((st.st_ino, st.st_size, st.st_mtime_ns))
+                    regular.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        return None
+    return _DirListing(
+        path=path,
+        files=files,
+        dirs=dirs,
+        regular=regular,
+        names=names,
+        sigs=sigs if with_sigs else None,
+        links=links,
+    )
+
+
+def _gitignore_regex(pattern: str) -> tuple[str, bool, bool] | None:
+    """
+    Translate one `.gitignore` line into (regex, dir_only, negated), the regex
+    matching paths relative to the ignore file's directory. None for blank
+    and comment lines.
+    """
+    line = pattern.rstrip("\r\n")
+    while line.endswith(" ") and not line.endswith("\\ "):
+        line = line[:-1]
+    if not line or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    # A slash anywhere but at the end anchors the pattern to its directory.
+    anchored = "/" in line
+    line = line.lstrip("/")
+
+    out: list[str] = [] if anchored else ["(?:.*/)?"]
+    i, n = 0, len(line)
+    while i < n:
+        c = line[i]
+        if c == "*":
+            if line.startswith("**", i) and (i == 0 or line[i - 1] == "/"):
+                if i + 2 == n:
+                    out.append(".*")
+                    i += 2
+                    continue
+                if line[i + 2] == "/":
+                    out.append("(?:.*/)?")
+                    i += 3
+                    continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and line[j] in "!^":
+                j += 1
+            if j < n and line[j] == "]":
+                j += 1
+            while j < n and line[j] != "]":
+                j += 1
+            if j >= n:
+                out.append(re.escape(c))
+            else:
+                body = line[i + 1 : j].replace("\\", "\\\\")
+                if body[:1] in ("!", "^"):
+                    body = "^" + body[1:]
+                out.append(f"(?!/)[{body}]")
+                i = j
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(line[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out), dir_only, negated
+
+
+@dataclass(frozen=True, slots=True)
+class _IgnoreRules:
+    """
+    The rules of one ignore file, compiled into one regex per entry type.
+
+    Alternatives are ordered last rule first and each is a capture group, so
+    `fullmatch` picks the last matching rule, as git does.
+    """
+
+    # Directory the rules are relative to, as "" (root) or "a/b/".
+    base: str
+    files: re.Pattern[str] | None
+    dirs: re.Pattern[str] | None
+    # Group numbers (in `files` and `dirs` respectively) of "!" rules.
+    negated_files: frozenset[int]
+    negated_dirs: frozenset[int]
+
+    def decide(self, rel: str, is_dir: bool) -> bool | None:
+        """True/False if a rule says ignored/kept, None if no rule matches."""
+        if not rel.startswith(self.base):
+            return None
+        pat, negated = (
+            (self.dirs, self.negated_dirs) if is_dir else (self.files, self.negated_files)
+        )
+        m = pat.fullmatch(rel, len(self.base)) if pat is not None else None
+        if m is None:
+            return None
+        return m.lastindex not in negated
+
+
+def _compile_ignore_rules(base: str, lines: Sequence[str]) -> _IgnoreRules | None:
+    rules = [r for r in map(_gitignore_regex, lines) if r is not None]
+    if not rules:
+        return None
+
+    def combine(for_dirs: bool) -> tuple[re.Pattern[str] | None, frozenset[int]]:
+        chosen = [(rx, neg) for rx, dir_only, neg in reversed(rules) if for_dirs or not dir_only]
+        if not chosen:
+            return None, frozenset()
+        pat = re.compile("|".join(f"({rx})" for rx, _ in chosen), flags=re.DOTALL)
+        return pat, frozenset(i for i, (_, neg) in enumerate(chosen, start=1) if neg)
+
+    files, negated_files = combine(False)
+    dirs, negated_dirs = combine(True)
+    return _IgnoreRules(base, files, dirs, negated_files, negated_dirs)
+
+
+_Chain = tuple[_IgnoreRules, ...]
+
+
+class _Ignore:
+    """
+    Which entries the walk prunes: `--exclude` patterns (rooted at the
+    input directory, always winning), then, with `gitignore`, every
+    `.gitignore` found on the way down, deepest first. `.git` directories
+    are always pruned in gitignore mode.
+    """
+
+    def __init__(self, excludes: Sequence[str], gitignore: bool) -> None:
+        self.excludes = _compile_ignore_rules("", excludes)
+        self.gitignore = gitignore
+        self.pruned_files = 0
+        self.pruned_dirs = 0
+        self._chains: dict[str, _Chain | None] = {}
+
+    def enter(
+        self, listing: _DirListing, base: str, chain: _Chain, syscalls: dict[str, int]
+    ) -> _Chain:
+        """`chain` extended with `listing`'s own `.gitignore`, if any."""
+        if not self.gitignore or ".gitignore" not in listing.regular:
+            return chain
+        return self._read(listing.path, base, chain, syscalls)
+
+    def _read(self, path: Path, base: str, chain: _Chain, syscalls: dict[str, int]) -> _Chain:
+        _count(syscalls, "open")
+        try:
+            text = (path / ".gitignore").read_text(encoding="utf-8", errors="replace")
+        except OSError:
+            return chain
+        rules = _compile_ignore_rules(base, text.splitlines())
+        return chain if rules is None else (*chain, rules)
+
+    def chain_for(self, root: Path, base: str, syscalls: dict[str, int]) -> _Chain | None:
+        """
+        The chain applying inside directory `base` ("" for `root`, else
+        ending in "/"), for paths reached without a walk from `root`; None
+        if `base` itself is ignored. Memoised.
+        """
+        if base in self._chains:
+            return self._chains[base]
+        chain: _Chain | None = ()
+        if base:
+            parent = base[:-1].rpartition("/")[0]
+            chain = self.chain_for(root, parent + "/" if parent else "", syscalls)
+            if chain is not None and self.ignored(base[:-1], True, chain):
+                chain = None
+        if chain is not None and self.gitignore:
+            chain = self._read(root / base, base, chain, syscalls)
+        self._chains[base] = chain
+        return chain
+
+    def ignored(self, rel: str, is_dir: bool, chain: _Chain) -> bool:
+        if self.excludes is not None:
+            verdict = self.excludes.decide(rel, is_dir)
+            if verdict is not None:
+                return verdict
+        if self.gitignore and is_dir and rel.rpartition("/")[2] == ".git":
+            return True
+        for rules in reversed(chain):
+            verdict = rules.decide(rel, is_dir)
+            if verdict is not None:
+                return verdict
+        return False
+
+    def prune(self, listing: _DirListing, base: str, chain: _Chain) -> None:
+        """Drop ignored entries from `listing` (they stay in `names`)."""
+        keep_dirs = [d for d in listing.dirs if not self.ignored(base + d, True, chain)]
+        self.pruned_dirs += len(listing.dirs) - len(keep_dirs)
+        listing.dirs = keep_dirs
+        if listing.links:
+            listing.links = [n for n in listing.links if not self.ignored(base + n, False, chain)]
+        kept = {f for f in listing.files if not self.ignored(base + f, False, chain)}
+        if len(kept) == len(listing.files):
+            return
+        self.pruned_files += len(listing.files) - len(kept)
+        listing.files = [f for f in listing.files if f in kept]
+        if listing.sigs is not None:
+            pairs = [(f, s) for f, s in zip(listing.regular, listing.sigs) if f in kept]
+            listing.regular = [f for f, _ in pairs]
+            listing.sigs = [s for _, s in pairs]
+        else:
+            listing.regular = [f for f in listing.regular if f in kept]
+
+
+def _walk_bottom_up(
+    root: Path,
+    syscalls: dict[str, int],
+    with_sigs: bool = False,
+    ignore: _Ignore | None = None,
+    base: str = "",
+    chain: _Chain = (),
+    threads: int = 1,
+) -> list[_DirListing]:
+    """
+    Same order as `os.walk(root, topdown=False)`: every directory comes after
+    all of its subdirectories. Unreadable directories are left out.
+
+    Discovery itself is top-down, so with `ignore` each directory is pruned
+    as soon as it is listed and ignored subtrees are never entered. A `root`
+    below the top of the ignore rules takes its path from there as `base`,
+    and the `chain` of its parent. With `threads > 1`, directories are listed
+    concurrently (`_walk_parallel`), for the same result.
+    """
+    if threads > 1:
+        return _walk_parallel(root, syscalls, with_sigs, ignore, base, chain, threads)
+    out: list[_DirListing] = []
+    top = _scan_dir(root, syscalls, with_sigs)
+    if top is None:
+        return out
+    if ignore is not None:
+        chain = ignore.enter(top, base, chain, syscalls)
+        ignore.prune(top, base, chain)
+    stack = [(top, iter(top.dirs), base, chain)]
+    while stack:
+        listing, pending, base, chain = stack[-1]
+        for dname in pending:
+            child = _scan_dir(listing.path / dname, syscalls, with_sigs)
+            if child is not None:
+                child_base = f"{base}{dname}/"
+                child_chain = chain
+                if ignore is not None:
+                    child_chain = ignore.enter(child, child_base, chain, syscalls)
+                    ignore.prune(child, child_base, child_chain)
+                stack.append((child, iter(child.dirs), child_base, child_chain))
+                break
+        else:
+            stack.pop()
+            out.append(listing)
+    return out
+
+
+def _walk_parallel(
+    root: Path,
+    syscalls: dict[str, int],
+    with_sigs: bool,
+    ignore: _Ignore | None,
+    base: str,
+    chain: _Chain,
+    threads: int,
+) -> list[_DirListing]:
+    """
+    `_walk_bottom_up` with `threads` threads listing directories.
+
+    Every listed directory queues its subdirectories on the pool's shared
+    queue, so whichever thread is idle takes the next one and wide or deep
+    subtrees spread over all threads. The listings are only put in order
+    once all are in: depth-first, subdirectories in listing order, exactly
+    as the single-threaded walk does, whatever order they completed in.
+    """
+    # Pruning updates the shared counters of `ignore`.
+    lock = threading.Lock()
+
+    def scan(
+        path: Path, base: str, chain: _Chain
+    ) -> tuple[_DirListing | None, _Chain, dict[str, int]]:
+        counts: dict[str, int] = {}
+        listing = _scan_dir(path, counts, with_sigs)
+        if listing is not None and ignore is not None:
+            chain = ignore.enter(listing, base, chain, counts)
+            with lock:
+                ignore.prune(listing, base, chain)
+        return listing, chain, counts
+
+    # Directory number -> its listing, its path from the top of the ignore
+    # rules, and the numbers of its subdirectories.
+    listings: list[_DirListing | None] = []
+    bases: list[str] = []
+    children: list[list[int]] = []
+    done: queue.SimpleQueue[tuple[int, Future[Any]]] = queue.SimpleQueue()
+    pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="switcheroo-walk")
+
+    def submit(path: Path, base: str, chain: _Chain) -> int:
+        i = len(listings)
+        listings.append(None)
+        bases.append(base)
+        children.append([])
+        future = pool.submit(scan, path, base, chain)
+        future.add_done_callback(lambda f: done.put((i, f)))
+        return i
+
+    try:
+        submit(root, base, chain)
+        pending = 1
+        while pending:
+            i, future = done.get()
+            pending -= 1
+            listing, chain, counts = future.result()
+            for name, n in counts.items():
+                _count(syscalls, name, n)
+            if listing is None:
+                continue
+            listings[i] = listing
+            for dname in listing.dirs:
+                children[i].append(submit(listing.path / dname, f"{bases[i]}{dname}/", chain))
+                pending += 1
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    out: list[_DirListing] = []
+    if listings[0] is None:
+        return out
+    stack = [(0, iter(children[0]))]
+    while stack:
+        i, pending_children = stack[-1]
+        for j in pending_children:
+            if listings[j] is not None:
+                stack.append((j, iter(children[j])))
+                break
+        else:
+            stack.pop()
+            listing = listings[i]
+            assert listing is not None
+            out.append(listing)
+    return out
+
+
+def _changed_tree(
+    root: Path,
+    paths: Sequence[Path],
+    syscalls: dict[str, int],
+    ignore: _Ignore | None = None,
+) -> list[_DirListing]:
+    """
+    `_walk_bottom_up` over just `paths` under `root`: files, or directories
+    taken whole. Each path sits in a listing of its parent holding only the
+    given entries (`complete=False`, so rename targets are checked on disk).
+    Walked directories come first, then those listings, deepest first.
+    """
+    walked: list[_DirListing] = []
+    parents: dict[Path, _DirListing] = {}
+    for path in paths:
+        rel = path.relative_to(root).as_posix()
+        _count(syscalls, "stat")
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue  # Gone again, or moved by an earlier rename.
+        is_dir = stat.S_ISDIR(st.st_mode)
+        if not (is_dir or stat.S_ISREG(st.st_mode)):
+            continue
+        chain: _Chain = ()
+        if ignore is not None:
+            parent = rel.rpartition("/")[0]
+            parent_chain = ignore.chain_for(root, parent + "/" if parent else "", syscalls)
+            if parent_chain is None or ignore.ignored(rel, is_dir, parent_chain):
+                if is_dir:
+                    ignore.pruned_dirs += 1
+                else:
+                    ignore.pruned_files += 1
+                continue
+            chain = parent_chain
+        listing = parents.get(path.parent)
+        if listing is None:
+            listing = _DirListing(
+                path=path.parent, files=[], dirs=[], regular=[], names=set(), complete=False
+            )
+            parents[path.parent] = listing
+        listing.names.add(path.name)
+        if is_dir:
+            listing.dirs.append(path.name)
+            walked += _walk_bottom_up(path, syscalls, ignore=ignore, base=rel + "/", chain=chain)
+        else:
+            listing.files.append(path.name)
+            listing.regular.append(path.name)
+    return walked + sorted(parents.values(), key=lambda d: len(d.path.parts), reverse=True)
+
+
+def _load_renameat2() -> Callable[..., int] | None:
+    """libc `renameat2`, for RENAME_NOREPLACE; None where unavailable."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        fn = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+    fn.restype = ctypes.c_int
+    return fn
+
+
+_RENAMEAT2 = _load_renameat2()
+_RENAME_NOREPLACE = 1
+_DIR_OPEN_FLAGS = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)
+_HAVE_DIR_FD = {os.open, os.stat, os.rename} <= os.supports_dir_fd
+
+
+class _DirHandle:
+    """
+    A directory opened (lazily) once, so that every stat/rename of a child
+    resolves just the child's name against the fd, not the whole path again.
+    A parent swapped for a symlink mid-run cannot redirect those calls.
+    """
+
+    def __init__(self, path: Path, syscalls: dict[str, int]) -> None:
+        self.path = path
+        self.syscalls = syscalls
+        self._fd: int | None = None
+
+    def _dir_fd(self) -> int | None:
+        if self._fd is None and _HAVE_DIR_FD:
+            _count(self.syscalls, "open")
+            self._fd = os.open(self.path, _DIR_OPEN_FLAGS)
+        return self._fd
+
+    def _arg(self, name: str) -> str | Path:
+        return name if _HAVE_DIR_FD else self.path / name
+
+    def exists(self, name: str) -> bool:
+        _count(self.syscalls, "stat")
+        try:
+            os.stat(self._arg(name), dir_fd=self._dir_fd(), follow_symlinks=False)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def rename(self, old: str, new: str) -> bool:
+        """
+        Rename `old` to `new`, never replacing an existing `new`: False if it
+        exists. Atomic via RENAME_NOREPLACE where the kernel and filesystem
+        support it, else checked just before renaming.
+        """
+        fd = self._dir_fd()
+        if fd is not None and _RENAMEAT2 is not None:
+            _count(self.syscalls, "rename")
+            if _RENAMEAT2(fd, os.fsencode(old), fd, os.fsencode(new), _RENAME_NOREPLACE) == 0:
+                return True
+            err = ctypes.get_errno()
+            if err == errno.EEXIST and old.casefold() != new.casefold():
+                return False
+            if err not in (errno.EEXIST, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise OSError(err, os.strerror(err), str(self.path / old))
+        # Case-only renames on case-insensitive filesystems land here too:
+        # `new` "exists" there, as `old` itself.
+        if old.casefold() != new.casefold() and self.exists(new):
+            return False
+        _count(self.syscalls, "rename")
+        os.rename(self._arg(old), self._arg(new), src_dir_fd=fd, dst_dir_fd=fd)
+        return True
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _is_case_insensitive(listing: _DirListing, syscalls: dict[str, int]) -> bool:
+    """
+    Probe (one lstat) whether the filesystem holding `listing` ignores case,
+    as on default macOS/Windows volumes, where a rename onto a name differing
+    only in case from a sibling would clobber it.
+    """
+    for name in listing.names:
+        probe = name.swapcase()
+        if probe != name and probe not in listing.names:
+            _count(syscalls, "stat")
+            return os.path.lexists(listing.path / probe)
+    return False
+
+
+@dataclass(frozen=True, slots=True)
+class _IndexEntry:
+    """One stage-0 entry of `.git/index` (stat fields as git truncates them)."""
+
+    path: str
+    mode: int
+    oid: str
+    mtime_ns: int
+    size: int
+    ino: int
+
+
+def _find_git_dir(path: Path) -> tuple[Path, Path]:
+    """(work tree root, git dir) of the checkout containing `path`."""
+    for top in (path, *path.parents):
+        dotgit = top / ".git"
+        if dotgit.is_dir():
+            return top, dotgit
+        if dotgit.is_file():
+            # Linked worktrees and submodules: ".git" is "gitdir: <path>".
+            line = dotgit.read_text(encoding="utf-8").strip()
+            if line.startswith("gitdir:"):
+                return top, (top / line[len("gitdir:") :].strip()).resolve()
+    raise ValueError(f"{path} is not inside a git checkout")
+
+
+def _git_oid_size(git_dir: Path) -> int:
+    """Bytes per object id: 32 in SHA-256 repositories, else 20."""
+    commondir = git_dir / "commondir"
+    if commondir.is_file():
+        git_dir = (git_dir / commondir.read_text(encoding="utf-8").strip()).resolve()
+    try:
+        config = (git_dir / "config").read_text(encoding="utf-8", errors="replace")
+    except OSError:
+        return 20
+    found = re.search(r"^\s*objectformat\s*=\s*sha256\s*$", config, re.IGNORECASE | re.MULTILINE)
+    return 32 if found else 20
+
+
+def _read_git_index(git_dir: Path) -> list[_IndexEntry]:
+    """
+    Parse `git_dir/index` (versions 2-4) without running git. Conflicted,
+    skip-worktree and gitlink entries are left out; extensions are ignored.
+    """
+    data = (git_dir / "index").read_bytes()
+    if data[:4] != b"DIRC":
+        raise ValueError(f"{git_dir / 'index'}: not a git index")
+    version, count = struct.unpack_from(">II", data, 4)
+    if version not in (2, 3, 4):
+        raise ValueError(f"{git_dir / 'index'}: unsupported index version {version}")
+    oid_size = _git_oid_size(git_dir)
+    head = struct.Struct(f">10I{oid_size}sH")
+
+    entries: list[_IndexEntry] = []
+    pos = 12
+    prev = b""
+    for _ in range(count):
+        start = pos
+        (_, _, mtime_s, mtime_ns, _, ino, mode, _, _, size, oid, flags) = head.unpack_from(
+            data, pos
+        )
+        pos += head.size
+        skip_worktree = False
+        if flags & 0x4000:
+            (extended,) = struct.unpack_from(">H", data, pos)
+            skip_worktree = bool(extended & 0x4000)
+            pos += 2
+        if version == 4:
+            # Name = previous name minus a varint-encoded suffix, plus a new one.
+            strip = data[pos] & 0x7F
+            while data[pos] & 0x80:
+                pos += 1
+                strip = ((strip + 1) << 7) | (data[pos] & 0x7F)
+            pos += 1
+            end = data.index(b"\0", pos)
+            name = prev[: len(prev) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index(b"\0", pos)
+            name = data[pos:end]
+            # Entries are NUL-padded to a multiple of 8 bytes.
+            pos = start + ((end - start + 8) & ~7)
+        prev = name
+
+        stage = (flags >> 12) & 3
+        if stage or skip_worktree or stat.S_IFMT(mode) == 0o160000:
+            continue
+        entries.append(
+            _IndexEntry(
+                path=os.fsdecode(name),
+                mode=mode,
+                oid=oid.hex(),
+                mtime_ns=mtime_s * 1_000_000_000 + mtime_ns,
+                size=size,
+                ino=ino,
+            )
+        )
+    return entries
+
+
+def _index_tree(
+    input_path: Path,
+    syscalls: dict[str, int],
+    with_sigs: bool = False,
+    ignore: _Ignore | None = None,
+) -> tuple[list[_DirListing], dict[Path, str]]:
+    """
+    `_walk_bottom_up` driven by the git index instead of `os.scandir`: only
+    tracked files under `input_path` (and the directories holding them) are
+    listed, one lstat each.
+
+    Also returns the blob id of every file whose stat data still matches the
+    index, i.e. whose contents are known to be that blob. Like git, files
+    modified no earlier than the index was written are not trusted.
+    """
+    top, git_dir = _find_git_dir(input_path.resolve())
+    prefix = input_path.resolve().relative_to(top).as_posix()
+    prefix = "" if prefix == "." else prefix + "/"
+    index_mtime_ns = (git_dir / "index").stat().st_mtime_ns
+
+    listings: dict[str, _DirListing] = {}
+
+    def listing_for(rel_dir: str) -> _DirListing:
+        listing = listings.get(rel_dir)
+        if listing is None:
+            path = input_path / rel_dir if rel_dir else input_path
+            listing = _DirListing(
+                path=path,
+                files=[],
+                dirs=[],
+                regular=[],
+                names=set(),
+                sigs=[] if with_sigs else None,
+                complete=False,
+            )
+            listings[rel_dir] = listing
+            if rel_dir:
+                parent, _, name = rel_dir.rpartition("/")
+                parent_listing = listing_for(parent)
+                parent_listing.dirs.append(name)
+                parent_listing.names.add(name)
+        return listing
+
+    listing_for("")
+    oids: dict[Path, str] = {}
+    for entry in _read_git_index(git_dir):
+        if not entry.path.startswith(prefix):
+            continue
+        rel = entry.path[len(prefix) :]
+        fpath = input_path / rel
+        _count(syscalls, "stat")
+        try:
+            st = os.lstat(fpath)
+        except OSError:
+            continue  # Deleted (or replaced by a directory) since it was staged.
+        if not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+            continue
+        rel_dir, _, name = rel.rpartition("/")
+        listing = listing_for(rel_dir)
+        listing.names.add(name)
+        if stat.S_ISLNK(st.st_mode):
+            listing.links.append(name)
+            continue
+        listing.files.append(name)
+        listing.regular.append(name)
+        if listing.sigs is not None:
+            listing.sigs.append((st.st_ino, st.st_size, st.st_mtime_ns))
+        if (
+            st.st_size & 0xFFFFFFFF == entry.size
+            and st.st_mtime_ns == entry.mtime_ns
+            and (entry.ino == 0 or st.st_ino & 0xFFFFFFFF == entry.ino)
+            and st.st_mtime_ns < index_mtime_ns
+        ):
+            oids[fpath] = entry.oid
+
+    out: list[_DirListing] = []
+    if ignore is not None:
+        ignore.prune(listings[""], "", ())
+    stack = [("", iter(listings[""].dirs))]
+    while stack:
+        rel_dir, pending = stack[-1]
+        for dname in pending:
+            child = f"{rel_dir}/{dname}" if rel_dir else dname
+            if ignore is not None:
+                ignore.prune(listings[child], child + "/", ())
+            stack.append((child, iter(listings[child].dirs)))
+            break
+        else:
+            stack.pop()
+            out.append(listings[rel_dir])
+    return out, oids
+
+
+# Kept in the root of the processed tree; never edited nor renamed itself.
+MANIFEST_NAME = ".switcheroo-manifest.sqlite"
+
+# Bump whenever matching or replacement semantics change: old entries then
+# stop applying because their fingerprint no longer matches.
+_MANIFEST_VERSION = 1
+
+# Files modified this close to the start of a run are not recorded: a later
+# write within the same mtime tick would otherwise go unnoticed.
+_RACY_WINDOW_NS = 2_000_000_000
+
+
+def _manifest_fingerprint(
+    pairs: Sequence[tuple[str, str]], strict: bool = False, sniff_bytes: int = DEFAULT_SNIFF_BYTES
+) -> str:
+    h = hashlib.sha256(f"switcheroo-manifest-v{_MANIFEST_VERSION}".encode())
+    for old, new in pairs:
+        h.update(f"\0{old}\t{new}".encode())
+    if strict:
+        h.update(b"\0strict")
+    # Which files count as binary depends on how much of them is sniffed.
+    if sniff_bytes != DEFAULT_SNIFF_BYTES:
+        h.update(f"\0sniff={sniff_bytes}".encode())
+    return h.hexdigest()
+
+
+def _moved_rel(rel: str, moves: dict[str, str]) -> str:
+    """Where `rel` (a path relative to the root) ended up after `moves`."""
+    if not moves:
+        return rel
+    parts = rel.split("/")
+    out = parts[:]
+    for i in range(len(parts)):
+        new_name = moves.get("/".join(parts[: i + 1]))
+        if new_name is not None:
+            out[i] = new_name
+    return "/".join(out)
+
+
+def _load_manifest(db_path: Path, fingerprint: str) -> dict[str, _FileSig]:
+    """Relative path -> signature of every file last seen without a match."""
+    if not db_path.is_file():
+        return {}
+    with closing(sqlite3.connect(db_path)) as db:
+        try:
+            rows = db.execute(
+                "SELECT path, ino, size, mtime_ns FROM clean WHERE fingerprint = ?",
+                (fingerprint,),
+            ).fetchall()
+        except sqlite3.DatabaseError:
+            return {}
+    return {path: (ino, size, mtime_ns) for path, ino, size, mtime_ns in rows}
+
+
+def _save_manifest(db_path: Path, fingerprint: str, clean: dict[str, _FileSig]) -> None:
+    """Replace this fingerprint's entries with `clean` (other fingerprints are kept)."""
+    with closing(sqlite3.connect(db_path)) as db, db:
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS clean ("
+            " path TEXT NOT NULL, fingerprint TEXT NOT NULL,"
+            " ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,"
+            " PRIMARY KEY (path, fingerprint))"
+        )
+        db.execute("DELETE FROM clean WHERE fingerprint = ?", (fingerprint,))
+        db.executemany(
+            "INSERT INTO clean (path, fingerprint, ino, size, mtime_ns) VALUES (?, ?, ?, ?, ?)",
+            ((path, fingerprint, *sig) for path, sig in clean.items()),
+        )
+
+
+# Blob ids already seen without a match, per pair fingerprint. Lives in
+# the git dir: blobs are immutable, so entries never go stale.
+_CLEAN_BLOBS_NAME = "switcheroo-clean-blobs.sqlite"
+
+
+def _load_clean_blobs(db_path: Path, fingerprint: str) -> set[str]:
+    if not db_path.is_file():
+        return set()
+    with closing(sqlite3.connect(db_path)) as db:
+        try:
+            rows = db.execute(
+                "SELECT oid FROM clean_blobs WHERE fingerprint = ?", (fingerprint,)
+            ).fetchall()
+        except sqlite3.DatabaseError:
+            return set()
+    return {oid for (oid,) in rows}
+
+
+def _save_clean_blobs(db_path: Path, fingerprint: str, oids: set[str]) -> None:
+    with closing(sqlite3.connect(db_path)) as db, db:
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS clean_blobs ("
+            " fingerprint TEXT NOT NULL, oid TEXT NOT NULL, PRIMARY KEY (fingerprint, oid))"
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO clean_blobs (fingerprint, oid) VALUES (?, ?)",
+            ((fingerprint, oid) for oid in oids),
+        )
+
+
+def _cpu_seconds() -> float:
+    """CPU time of this process plus that of its reaped children (pool workers)."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class _PhaseClock:
+    """Wall and CPU seconds of consecutive run phases."""
+
+    def __init__(self) -> None:
+        self.wall: dict[str, float] = {}
+        self.cpu: dict[str, float] = {}
+        self.start()
+
+    def start(self) -> None:
+        self._wall, self._cpu = time.perf_counter(), _cpu_seconds()
+
+    def stop(self, phase: str) -> None:
+        self.wall[phase] = time.perf_counter() - self._wall
+        self.cpu[phase] = _cpu_seconds() - self._cpu
+
+
+# How many of the biggest files `Stats.largest_files` keeps.
+_LARGEST_FILES = 10
+
+
+def merge_stats(runs: Sequence[Stats]) -> Stats:
+    """
+    Totals of several runs (watch passes, shards, ...): counts, bytes,
+    seconds and per-key tallies are summed, the largest files merged, and
+    rates recomputed from the totals.
+    """
+    merged: dict[str, Any] = {}
+    for f in dataclasses.fields(Stats):
+        values = [getattr(s, f.name) for s in runs]
+        if f.name in ("files_per_second", "dedup_hit_rate"):
+            continue
+        if f.name == "largest_files":
+            files = [(str(path), int(size)) for v in values for path, size in v]
+            merged[f.name] = heapq.nlargest(_LARGEST_FILES, files, key=lambda x: x[1])
+        elif isinstance(f.default, (int, float)):
+            merged[f.name] = sum(values, f.default)
+        else:
+            total: dict[str, Any] = {}
+            for v in values:
+                for k, n in v.items():
+                    total[k] = total.get(k, 0) + n
+            merged[f.name] = total
+    content = merged["phase_seconds"].get("content", 0.0)
+    files = sum(s.files_per_second * s.phase_seconds.get("content", 0.0) for s in runs)
+    merged["files_per_second"] = files / content if content > 0 else 0.0
+    lookups = merged["dedup_hits"] + merged["dedup_misses"]
+    merged["dedup_hit_rate"] = merged["dedup_hits"] / lookups if lookups else 0.0
+    return Stats(**merged)
+
+
+@dataclass(frozen=True, slots=True)
+class ContentEdit:
+    """A file whose contents were rewritten (or would be, in a dry run)."""
+
+    path: Path
+    matches: int
+
+
+@dataclass(frozen=True, slots=True)
+class FileRename:
+    src: Path
+    dst: Path
+
+
+@dataclass(frozen=True, slots=True)
+class DirRename:
+    src: Path
+    dst: Path
+    # The root directory itself, always the last rename.
+    root: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class Collision:
+    """A rename not done because its destination is taken."""
+
+    # "file", "dir" or "root".
+    kind: str
+    src: Path
+    dst: Path
+
+
+@dataclass(frozen=True, slots=True)
+class Skip:
+    """A file whose contents were skipped, and why (a `Stats.skipped_files` key)."""
+
+    path: Path
+    reason: str
+
+
+@dataclass(frozen=True, slots=True)
+class Done:
+    """The last event of every run."""
+
+    stats: Stats
+
+
+ChangeEvent = ContentEdit | FileRename | DirRename | Collision | Skip | Done
+
+
+def _rename_event(kind: str, src: Path, dst: Path) -> FileRename | DirRename:
+    if kind == "file":
+        return FileRename(src, dst)
+    return DirRename(src, dst, root=kind == "root")
+
+
+def _log_change(events: EventSink, change: ChangeEvent) -> None:
+    """Send renames and collisions to `events`, as "rename"/"collision" events."""
+    if isinstance(change, FileRename | DirRename):
+        kind = "file" if isinstance(change, FileRename) else "root" if change.root else "dir"
+        events.emit("rename", kind=kind, src=str(change.src), dst=str(change.dst))
+    elif isinstance(change, Collision):
+        events.emit("collision", kind=change.kind, src=str(change.src), dst=str(change.dst))
+
+
+class EventSink:
+    """
+    Receives one event per action (rename, collision, ...) and counts them
+    per kind in `counts`. This base class writes nothing: the quiet backend.
+    """
+
+    def __init__(self) -> None:
+        self.counts: Counter[str] = Counter()
+
+    def emit(self, event: str, **fields: object) -> None:
+        self.counts[event] += 1
+        self._write(event, fields)
+
+    def _write(self, event: str, fields: dict[str, object]) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+QuietSink = EventSink
+
+
+class _LineSink(EventSink):
+    """Formats each event as one line and writes them `batch` at a time."""
+
+    def __init__(self, stream: TextIO, batch: int = 1024, close_stream: bool = False) -> None:
+        super().__init__()
+        self.stream = stream
+        self.batch = batch
+        self.close_stream = close_stream
+        self._lines: list[str] = []
+
+    def _format(self, event: str, fields: dict[str, object]) -> str:
+        raise NotImplementedError
+
+    def _write(self, event: str, fields: dict[str, object]) -> None:
+        self._lines.append(self._format(event, fields))
+        if len(self._lines) >= self.batch:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._lines:
+            self.stream.write("\n".join(self._lines) + "\n")
+            self._lines.clear()
+        self.stream.flush()
+
+    def close(self) -> None:
+        self.flush()
+        if self.close_stream:
+            self.stream.close()
+
+
+class HumanSink(_LineSink):
+    """The classic `[rename] file: a -> b` lines."""
+
+    def _format(self, event: str, fields: dict[str, object]) -> str:
+        kind = str(fields.get("kind", ""))
+        if event == "rename":
+            return f"[rename] {kind + ':':<5} {fields['src']} -> {fields['dst']}"
+        if event == "collision":
+            return f"[collision] skip rename {kind}: {fields['src']} -> {fields['dst']}"
+        if event == "edit":
+            return f"[edit] {fields['path']}"
+        if event == "stale":
+            action = f"{fields['action']} {kind}".rstrip()
+            return f"[stale] skip {action}: {fields['path']} ({fields['reason']})"
+        return f"[{event}] " + " ".join(f"{k}={v}" for k, v in fields.items())
+
+
+class NdjsonSink(_LineSink):
+    """One JSON object per event: ``{"event": ..., **fields}``."""
+
+    def _format(self, event: str, fields: dict[str, object]) -> str:
+        return json.dumps({"event": event, **fields})
+
+
+def _lay_out_output(
+    tree: Sequence[_DirListing],
+    input_path: Path,
+    output_dir: Path,
+    rules: _Rules,
+    hits: list[int],
+    dry_run: bool,
+    syscalls: dict[str, int],
+) -> Generator[ChangeEvent, None, tuple[dict[Path, Path], int, int]]:
+    """
+    Create the renamed directories of `tree` under `output_dir` (which stands
+    for `input_path`), parents first, and recreate its symlinks there.
+
+    Names go through the same replacement and collision rules as in-place
+    renames, and each rename or collision is yielded. Returns the destination
+    of every regular file, plus the number of renames and of collisions.
+    """
+    dests: dict[Path, Path] = {}
+    out_dirs = {input_path: output_dir}
+    renamed = 0
+    collisions = 0
+    case_insensitive: bool | None = None
+    if not dry_run:
+        _count(syscalls, "mkdir")
+        output_dir.mkdir(parents=True, exist_ok=True)
+    # `tree` is post-order, so reversed it lists every directory before its
+    # subdirectories.
+    for listing in reversed(tree):
+        out = out_dirs[listing.path]
+        new_names: dict[str, str] = {}
+        for kind, names in (("file", listing.files), ("dir", listing.dirs)):
+            for name in names:
+                new_names[name] = name
+                new_name, changed = _replace_in_text(name, rules, hits)
+                if not changed or new_name == name:
+                    continue
+                if case_insensitive is None:
+                    case_insensitive = _is_case_insensitive(listing, syscalls)
+                src = listing.path / name
+                if listing.taken(name, new_name, case_insensitive):
+                    collisions += 1
+                    yield Collision(kind, src, out / new_name)
+                    continue
+                renamed += 1
+                yield _rename_event(kind, src, out / new_name)
+                listing.moved(name, new_name)
+                new_names[name] = new_name
+
+        for name in listing.dirs:
+            out_dirs[listing.path / name] = out / new_names[name]
+            if not dry_run:
+                _count(syscalls, "mkdir")
+                (out / new_names[name]).mkdir()
+        for name in listing.regular:
+            dests[listing.path / name] = out / new_names[name]
+        if dry_run:
+            continue
+        for name in listing.links:
+            _count(syscalls, "symlink")
+            try:
+                os.symlink(os.readlink(listing.path / name), out / name)
+            except OSError:
+                continue
+    return dests, renamed, collisions
+
+
+def _shard_of(rel: str, shards: int) -> int:
+    """Stable shard (0-based) of a root-relative POSIX path, on any machine."""
+    digest = hashlib.blake2b(rel.encode("utf-8", "surrogateescape"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+class SwitcherooOptions(TypedDict, total=False):
+    """
+    The options of `iter_switcheroo` that `switcheroo`, `watch` and
+    `write_plan` pass through as they are (see `iter_switcheroo`).
+    """
+
+    old_string: str
+    new_string: str
+    mapping: Sequence[tuple[str, str]]
+    strict: bool
+    dry_run: bool
+    jobs: int
+    stream_threshold: int
+    max_match_len: int
+    manifest: bool
+    rebuild_manifest: bool
+    exclude: Sequence[str]
+    gitignore: bool
+    git: bool
+    output_dir: Path | None
+    link_mode: str
+    dedup: bool
+    shard: tuple[int, int] | None
+    renames_only: bool
+    include_ext: Sequence[str]
+    exclude_ext: Sequence[str]
+    max_size: int
+    sniff_bytes: int
+    prefetch: int
+    prefetch_depth: int
+    walk_threads: int
+    mmap_threshold: int
+
+
+def iter_switcheroo(
+    *,
+    input_path: Path,
+    old_string: str = "",
+    new_string: str = "",
+    mapping: Sequence[tuple[str, str]] = (),
+    strict: bool = False,
+    dry_run: bool = False,
+    jobs: int = 1,
+    stream_threshold: int = DEFAULT_STREAM_THRESHOLD,
+    max_match_len: int = DEFAULT_MAX_MATCH_LEN,
+    manifest: bool = False,
+    rebuild_manifest: bool = False,
+    plan: Callable[[dict[str, object]], object] | None = None,
+    exclude: Sequence[str] = (),
+    gitignore: bool = False,
+    git: bool = False,
+    output_dir: Path | None = None,
+    link_mode: str = "hardlink",
+    dedup: bool = True,
+    only: Sequence[Path] | None = None,
+    shard: tuple[int, int] | None = None,
+    renames_only: bool = False,
+    include_ext: Sequence[str] = (),
+    exclude_ext: Sequence[str] = (),
+    max_size: int = 0,
+    sniff_bytes: int = DEFAULT_SNIFF_BYTES,
+    prefetch: int = 0,
+    prefetch_depth: int = 0,
+    walk_threads: int = 1,
+    mmap_threshold: int = DEFAULT_MMAP_THRESHOLD,
+    journal: Callable[[dict[str, object]], object] | None = None,
+) -> Iterator[ChangeEvent]:
+    """
+    Replace `old_string` with `new_string`, plus every pair in `mapping`, in
+    one pass over the tree: each file is read, matched and written once.
+
+    Lazily: every change is yielded as it is made (`ContentEdit` or `Skip`
+    per file, then `FileRename`, `DirRename` or `Collision`), and `Done`
+    with the run's `Stats` comes last. Nothing runs, and nothing is checked,
+    before the first event is asked for. Stopping early (`close()`, or
+    leaving a `for` loop) leaves the rest undone: renames come after every
+    edit, files already handed to `jobs` workers may still be edited, and
+    the manifest is not updated. Time the consumer spends between events
+    counts towards the phase it interrupts.
+    `strict` only matches exact spellings (any case), without separators.
+
+    With `manifest`, files found without a match are recorded in
+    `MANIFEST_NAME` (by relative path, inode, size, mtime and a fingerprint
+    of the pairs) and skipped by later runs while unchanged.
+    `rebuild_manifest` ignores the recorded entries and rewrites them.
+    Dry runs only read the manifest.
+
+    `exclude` takes gitignore-style patterns, relative to `input_path`; with
+    `gitignore`, `.gitignore` files (and `.git` directories) are honoured
+    too. Matching directories are pruned before they are ever listed.
+
+    With `git`, files come from the git index of the checkout holding
+    `input_path` instead of a directory walk (tracked files only), and files
+    whose blob id was already found match-free are not read at all.
+
+    With `plan`, nothing is modified: every action is passed to `plan` as a
+    record for `apply_plan` instead (see `write_plan`).
+
+    With `output_dir` (new or empty), `input_path` is left untouched and the
+    renamed tree is built there instead: edited files are written, the rest
+    are placed according to `link_mode` ("hardlink", "reflink" or "copy",
+    each falling back to a copy) and symlinks are recreated.
+
+    With `dedup`, files with the same bytes are matched once per process:
+    repeats reuse the outcome (and rewritten bytes) of the first one.
+
+    `only` limits the run to these paths under `input_path` (files, or
+    directories taken whole) instead of the whole tree, as `watch` does; the
+    root is not renamed then.
+
+    With `shard` as (I, N), only the files of shard I of N (1-based; see
+    `_shard_of`) are edited and nothing is renamed; `renames_only` skips the
+    content phase, to do the renames once all shards are done.
+
+    The contents of files with an extension in `exclude_ext`, or not in a
+    non-empty `include_ext` ("py" or ".py"), or larger than `max_size` (if
+    set), are skipped without being read; so are those whose first
+    `sniff_bytes` (0: no sniffing) hold a NUL byte or invalid UTF-8. All are
+    still renamed.
+
+    With `prefetch` (`jobs` must be 1), that many threads read files ahead of
+    the content phase, holding at most `prefetch_depth` (default: 4 per
+    thread) at a time. `walk_threads` threads list directories.
+
+    ASCII files of at least `mmap_threshold` bytes (0: none) are matched and
+    rewritten from a memory map, without ever being decoded.
+
+    With `journal` (`jobs` must be 1), every change is also passed to it as
+    a record for `undo_journal` (see `switcheroo`) before it is made: edits
+    right before the file is overwritten or replaced, renames right before
+    they are attempted (a rename that then collides is recorded anyway, and
+    left alone by the undo).
+    """
+    if not input_path.exists():
+        raise FileNotFoundError(str(input_path))
+    if not input_path.is_dir():
+        raise NotADirectoryError(str(input_path))
+    if output_dir is not None:
+        if plan is not None or manifest or rebuild_manifest:
+            raise ValueError("output_dir cannot be combined with a plan or a manifest")
+        if link_mode not in _LINK_MODES:
+            raise ValueError(f"link_mode must be one of {', '.join(_LINK_MODES)}")
+        resolved = input_path.resolve()
+        out = output_dir.resolve()
+        if out == resolved or resolved in out.parents:
+            raise ValueError("output_dir must not be inside input_path")
+        if output_dir.exists() and (not output_dir.is_dir() or any(output_dir.iterdir())):
+            raise FileExistsError(f"output_dir is not an empty directory: {output_dir}")
+    if only is not None and (plan is not None or manifest or rebuild_manifest or git):
+        raise ValueError("only cannot be combined with a plan, a manifest or git")
+    if shard is not None or renames_only:
+        if plan is not None or manifest or rebuild_manifest or output_dir or only is not None:
+            raise ValueError(
+                "shard and renames_only cannot be combined with a plan, a manifest,"
+                " output_dir or only"
+            )
+        if shard is not None and renames_only:
+            raise ValueError("shard and renames_only are separate steps")
+        if shard is not None and not 1 <= shard[0] <= shard[1]:
+            raise ValueError(f"shard must be (I, N) with 1 <= I <= N, got {shard}")
+    if max_size < 0 or sniff_bytes < 0 or mmap_threshold < 0:
+        raise ValueError("max_size, sniff_bytes and mmap_threshold must not be negative")
+    if prefetch < 0 or prefetch_depth < 0:
+        raise ValueError("prefetch and prefetch_depth must not be negative")
+    if prefetch and jobs != 1:
+        raise ValueError("prefetch reads ahead for a single process: use it with jobs=1")
+    if walk_threads < 1:
+        raise ValueError("walk_threads must be at least 1")
+    if journal is not None and (dry_run or plan is not None or output_dir is not None):
+        raise ValueError("journal cannot be combined with dry_run, a plan or output_dir")
+    if journal is not None and jobs != 1:
+        raise ValueError("journal records each edit before it is made: use it with jobs=1")
+
+    pairs = ([(old_string, new_string)] if old_string or new_string else []) + list(mapping)
+    rules = _compile_rules(pairs, strict)
+    if max_match_len < rules.max_old_len:
+        raise ValueError("max_match_len must be at least len(old_string)")
+
+    hits = [0] * len(rules.new_strings)
+    dry_run = dry_run or plan is not None
+    job = _ContentJob(
+        rules=rules,
+        dry_run=dry_run,
+        stream_threshold=stream_threshold,
+        max_match_len=max_match_len,
+        plan=plan is not None,
+        link_mode=link_mode,
+        dedup=_DedupCache() if dedup else None,
+        include_ext=frozenset(_normalize_ext(x) for x in include_ext),
+        exclude_ext=frozenset(_normalize_ext(x) for x in exclude_ext),
+        max_size=max_size,
+        sniff_bytes=sniff_bytes,
+        mmap_threshold=mmap_threshold,
+    )
+    journaled = 0
+    if journal is not None:
+        journal({"op": "journal", "version": _JOURNAL_VERSION, "root": str(input_path.resolve())})
+
+        def journal_edit(fpath: Path, sha256: str, undo: tuple[_Patch, ...]) -> None:
+            nonlocal journaled
+            journaled += 1
+            journal(
+                {
+                    "op": "edit",
+                    "path": fpath.relative_to(input_path).as_posix(),
+                    "sha256": sha256,
+                    "patches": [list(p) for p in undo],
+                }
+            )
+
+        job = dataclasses.replace(job, journal=journal_edit)
+
+    def rename(handle: _DirHandle, old: str, new: str, record: dict[str, object]) -> bool:
+        """`handle.rename`, journaled first."""
+        nonlocal journaled
+        if journal is not None:
+            journaled += 1
+            journal(record)
+        return handle.rename(old, new)
+
+    if plan is not None:
+        plan(
+            {
+                "op": "plan",
+                "version": _PLAN_VERSION,
+                "root": str(input_path.resolve()),
+                "pairs": [list(p) for p in pairs],
+            }
+        )
+    planned = 0
+
+    renamed = 0
+    edited = 0
+    skipped = 0
+    collisions = 0
+    rejected = 0
+    saved_bytes = 0
+    streamed = 0
+    syscalls: dict[str, int] = {}
+    started_ns = time.time_ns()
+
+    manifest = manifest or rebuild_manifest
+    db_path = input_path / MANIFEST_NAME
+    fingerprint = _manifest_fingerprint(pairs, strict, sniff_bytes)
+    known: dict[str, _FileSig] = {}
+    if manifest and not rebuild_manifest:
+        known = _load_manifest(db_path, fingerprint)
+
+    # Bottom-up: rename children before parents so traversal isn't disrupted.
+    # The walk is materialised first so the content phase can run over every
+    # file at once (possibly in parallel) before any path changes.
+    ignore = _Ignore(exclude, gitignore) if exclude or gitignore else None
+    clock = _PhaseClock()
+    oids: dict[Path, str] = {}
+    blobs_db: Path | None = None
+    clean_blobs: set[str] = set()
+    if git:
+        tree, oids = _index_tree(input_path, syscalls, with_sigs=manifest, ignore=ignore)
+        blobs_db = _find_git_dir(input_path.resolve())[1] / _CLEAN_BLOBS_NAME
+        clean_blobs = _load_clean_blobs(blobs_db, fingerprint)
+    elif only is not None:
+        tree = _changed_tree(input_path, only, syscalls, ignore)
+    else:
+        tree = _walk_bottom_up(
+            input_path, syscalls, with_sigs=manifest, ignore=ignore, threads=walk_threads
+        )
+    clock.stop("walk")
+
+    # With output_dir, every name is decided (and every directory created)
+    # up front, so files can go straight to their destination.
+    file_dests: dict[Path, Path] = {}
+    if output_dir is not None:
+        file_dests, renamed, collisions = yield from _lay_out_output(
+            tree, input_path, output_dir, rules, hits, dry_run, syscalls
+        )
+
+    # 1) Edit file contents first (paths stable).
+    paths: list[Path] = []
+    placed: Counter[str] = Counter()
+    rel_sigs: list[tuple[str, _FileSig]] = []
+    clean: dict[str, _FileSig] = {}
+    blob_skipped = 0
+    shard_skipped = 0
+    new_clean_blobs: set[str] = set()
+    # Shards only: the listing's path relative to the root, with a trailing "/".
+    base = ""
+    for listing in tree if not renames_only else ():
+        sigs = listing.sigs or []
+        if shard is not None:
+            base = listing.path.relative_to(input_path).as_posix()
+            base = "" if base == "." else base + "/"
+        for i, fname in enumerate(listing.regular):
+            if shard is not None and _shard_of(base + fname, shard[1]) != shard[0] - 1:
+                shard_skipped += 1
+                continue
+            fpath = listing.path / fname
+            if oids.get(fpath) in clean_blobs:
+                blob_skipped += 1
+                if output_dir is not None and not dry_run:
+                    placed[_place_file(fpath, file_dests[fpath], link_mode, syscalls)] += 1
+                continue
+            if manifest:
+                if listing.path == input_path and fname.startswith(MANIFEST_NAME):
+                    continue
+                rel = fpath.relative_to(input_path).as_posix()
+                if known.get(rel) == sigs[i]:
+                    clean[rel] = sigs[i]
+                    continue
+                rel_sigs.append((rel, sigs[i]))
+            paths.append(fpath)
+    manifest_skipped = len(clean)
+
+    clock.start()
+    steps: dict[str, float] = {}
+    # Min-heap of (size, index into `paths`).
+    largest: list[tuple[int, int]] = []
+    by_extension: Counter[str] = Counter()
+    dedup_hit_bytes = 0
+    skip_reasons: Counter[str] = Counter()
+    dests = [file_dests[p] for p in paths] if output_dir is not None else None
+    outcomes = _iter_content_outcomes(
+        paths, job, _resolve_jobs(jobs), dests, prefetch, prefetch_depth
+    )
+    for k, result in enumerate(outcomes):
+        is_clean = (
+            result.outcome in (_UNCHANGED, _REJECTED, _SKIPPED)
+            and result.reason not in _UNSCANNED_SKIPS
+        )
+        if manifest and is_clean:
+            rel, sig = rel_sigs[k]
+            if sig[2] < started_ns - _RACY_WINDOW_NS:
+                clean[rel] = sig
+        if oids and is_clean:
+            oid = oids.get(paths[k])
+            if oid is not None:
+                new_clean_blobs.add(oid)
+        if plan is not None and result.outcome == _EDITED:
+            planned += 1
+            plan(
+                {
+                    "op": "edit",
+                    "path": paths[k].relative_to(input_path).as_posix(),
+                    "size": result.size,
+                    "sha256": result.sha256,
+                    "spans": [list(s) for s in result.spans],
+                }
+            )
+        streamed += result.streamed
+        if "dedup_hits" in result.metrics:
+            dedup_hit_bytes += result.size
+        if result.placed:
+            placed[result.placed] += 1
+        for name, n in result.syscalls.items():
+            _count(syscalls, name, n)
+        for name, value in result.metrics.items():
+            steps[name] = steps.get(name, 0.0) + value
+        if len(largest) < _LARGEST_FILES:
+            heapq.heappush(largest, (result.size, k))
+        elif result.size > largest[0][0]:
+            heapq.heapreplace(largest, (result.size, k))
+        if result.outcome == _EDITED:
+            edited += 1
+            for i, n in enumerate(result.counts):
+                hits[i] += n
+            by_extension[paths[k].suffix.lower()] += sum(result.counts)
+            yield ContentEdit(paths[k], sum(result.counts))
+        elif result.outcome == _SKIPPED:
+            skip_reasons[result.reason] += 1
+            skipped += result.reason not in _POLICY_SKIPS
+            yield Skip(paths[k], result.reason)
+        elif result.outcome == _REJECTED:
+            rejected += 1
+            saved_bytes += result.size
+
+    clock.stop("content")
+
+    if blobs_db is not None and new_clean_blobs and not dry_run:
+        _save_clean_blobs(blobs_db, fingerprint, new_clean_blobs)
+
+    clock.start()
+    # Original relative path -> new base name, to re-key `clean` after renames.
+    moves: dict[str, str] = {}
+    case_insensitive: bool | None = None
+    # With output_dir, `_lay_out_output` already did 2) and 3); shards leave
+    # them to a later `renames_only` run.
+    for listing in tree if output_dir is None and shard is None else ():
+        root_path = listing.path
+        # Opened on the first rename; children are then renamed relative to it.
+        with closing(_DirHandle(root_path, syscalls)) as handle:
+            for kind, names in (("file", listing.files), ("dir", listing.dirs)):
+                # 2) Rename files (after content edits), then
+                # 3) directories in this root (still bottom-up overall).
+                for name in names:
+                    new_name, changed = _replace_in_text(name, rules, hits)
+                    if not changed or new_name == name:
+                        continue
+
+                    if case_insensitive is None:
+                        case_insensitive = _is_case_insensitive(listing, syscalls)
+                    old_path = root_path / name
+                    new_path = root_path / new_name
+                    record: dict[str, object] = {
+                        "op": "rename",
+                        "kind": kind,
+                        "path": old_path.relative_to(input_path).as_posix(),
+                        "to": new_name,
+                    }
+                    if (
+                        listing.taken(name, new_name, case_insensitive)
+                        or (not listing.complete and handle.exists(new_name))
+                        or (not dry_run and not rename(handle, name, new_name, record))
+                    ):
+                        collisions += 1
+                        yield Collision(kind, old_path, new_path)
+                        continue
+
+                    renamed += 1
+                    yield _rename_event(kind, old_path, new_path)
+                    listing.moved(name, new_name)
+                    if manifest:
+                        moves[old_path.relative_to(input_path).as_posix()] = new_name
+                    if plan is not None:
+                        planned += 1
+                        plan(record)
+
+    # Rename the root directory name itself (optional, but you asked "including root directory given").
+    parent = input_path.parent
+    root_name = input_path.name
+    new_root_name, changed = root_name, False
+    if output_dir is None and only is None and shard is None:
+        new_root_name, changed = _replace_in_text(root_name, rules, hits)
+    if changed and new_root_name != root_name:
+        new_root = parent / new_root_name
+        record = {"op": "rename", "kind": "root", "path": ".", "to": new_root_name}
+        with closing(_DirHandle(parent, syscalls)) as handle:
+            if handle.exists(new_root_name) or (
+                not dry_run and not rename(handle, root_name, new_root_name, record)
+            ):
+                collisions += 1
+                yield Collision("root", input_path, new_root)
+            else:
+                renamed += 1
+                yield DirRename(input_path, new_root, root=True)
+                if plan is not None:
+                    planned += 1
+                    plan(record)
+                if not dry_run:
+                    db_path = new_root / MANIFEST_NAME
+
+    if manifest and not dry_run:
+        moved = {_moved_rel(rel, moves): sig for rel, sig in clean.items()}
+        _save_manifest(db_path, fingerprint, moved)
+    if plan is not None:
+        plan({"op": "end", "actions": planned})
+    if journal is not None:
+        journal({"op": "end", "actions": journaled})
+    clock.stop("rename")
+
+    bytes_read = int(steps.pop("bytes_read", 0))
+    bytes_written = int(steps.pop("bytes_written", 0))
+    dedup_hits = int(steps.pop("dedup_hits", 0))
+    dedup_misses = int(steps.pop("dedup_misses", 0))
+    mmap_files = int(steps.pop("mmap_files", 0))
+    mmap_copied = int(steps.pop("mmap_bytes_copied", 0))
+    mmap_touched = int(steps.pop("mmap_bytes_touched", 0))
+    content_wall = clock.wall["content"]
+
+    yield Done(
+        Stats(
+            renamed_paths=renamed,
+            edited_files=edited,
+            skipped_binary_or_nonutf8=skipped,
+            rename_collisions=collisions,
+            prefilter_rejected_files=rejected,
+            prefilter_saved_bytes=saved_bytes,
+            streamed_files=streamed,
+            matches_by_pair=rules.pair_counts(hits),
+            syscalls=dict(sorted(syscalls.items())),
+            manifest_skipped_files=manifest_skipped,
+            pruned_dirs=ignore.pruned_dirs if ignore is not None else 0,
+            pruned_files=ignore.pruned_files if ignore is not None else 0,
+            walk_seconds=clock.wall["walk"],
+            blob_skipped_files=blob_skipped,
+            phase_seconds={**clock.wall, **dict(sorted(steps.items()))},
+            phase_cpu_seconds=clock.cpu,
+            bytes_read=bytes_read,
+            bytes_written=bytes_written,
+            files_per_second=len(paths) / content_wall if content_wall > 0 else 0.0,
+            largest_files=[(str(paths[k]), size) for size, k in sorted(largest, reverse=True)],
+            matches_by_extension=dict(by_extension.most_common()),
+            output_files=dict(sorted(placed.items())),
+            dedup_hits=dedup_hits,
+            dedup_misses=dedup_misses,
+            dedup_hit_bytes=dedup_hit_bytes,
+            dedup_hit_rate=dedup_hits / (dedup_hits + dedup_misses) if dedup_hits else 0.0,
+            shard_skipped_files=shard_skipped,
+            skipped_files=dict(sorted(skip_reasons.items())),
+            mmap_files=mmap_files,
+            mmap_bytes_copied=mmap_copied,
+            mmap_bytes_touched=mmap_touched,
+        )
+    )
+
+
+def switcheroo(
+    *,
+    input_path: Path,
+    events: EventSink | None = None,
+    journal_path: Path | None = None,
+    plan: Callable[[dict[str, object]], object] | None = None,
+    only: Sequence[Path] | None = None,
+    **options: Unpack[SwitcherooOptions],
+) -> Stats:
+    """
+    Run `iter_switcheroo` to the end and return its `Stats`.
+
+    Renames and collisions are reported to `events` (default: human-readable
+    lines on stdout, written as they happen).
+
+    With `journal_path` (a new file, outside the tree), every change is
+    appended to it as NDJSON right before it is made (see `iter_switcheroo`),
+    one record per line, for `undo_journal`:
+
+    - ``{"op": "journal", "version", "root"}`` header;
+    - ``{"op": "edit", "path", "sha256", "patches"}`` per edited file, with
+      `sha256` the digest of its new contents and `patches` as
+      ``[offset, old, new]``: `new` starts at byte `offset` of those and
+      replaced `old`;
+    - ``{"op": "rename", "kind", "path", "to"}`` per rename, as in a plan
+      (see `write_plan`);
+    - ``{"op": "end", "actions"}`` trailer, missing if the run was cut short.
+    """
+    if events is None:
+        events = HumanSink(sys.stdout, batch=1)
+    if journal_path is None:
+        changes = iter_switcheroo(input_path=input_path, plan=plan, only=only, **options)
+        return _drain(changes, events)
+    if input_path.resolve() in journal_path.resolve().parents:
+        raise ValueError("journal_path must not be inside input_path")
+    out: TextIO | None = None
+
+    def record(entry: dict[str, object]) -> None:
+        nonlocal out
+        if out is None:
+            # Created with the header, once the options passed their checks.
+            # Line-buffered: each record leaves the process as it is made.
+            out = journal_path.open("x", encoding="utf-8", buffering=1)
+        out.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    try:
+        changes = iter_switcheroo(
+            input_path=input_path, plan=plan, only=only, journal=record, **options
+        )
+        return _drain(changes, events)
+    finally:
+        if out is not None:
+            out.close()
+
+
+def _drain(changes: Iterator[ChangeEvent], events: EventSink) -> Stats:
+    stats = Stats()
+    for change in changes:
+        if isinstance(change, Done):
+            stats = change.stats
+        else:
+            _log_change(events, change)
+    events.flush()
+    return stats
+
+
+class _TeeSink(EventSink):
+    """Forwards events to `inner`, remembering where renamed paths went."""
+
+    def __init__(self, inner: EventSink) -> None:
+        super().__init__()
+        self.inner = inner
+        self.moved: dict[str, str] = {}
+
+    def _write(self, event: str, fields: dict[str, object]) -> None:
+        self.inner.emit(event, **fields)
+        if event == "rename":
+            self.moved[str(fields["src"])] = str(fields["dst"])
+
+    def flush(self) -> None:
+        self.inner.flush()
+
+
+def _watched_paths(
+    changes: Iterable[tuple[bool, str]], root: Path, settled: dict[str, _FileSig]
+) -> list[Path]:
+    """
+    What one batch of watch events, as (created, absolute path), calls for:
+    created or modified files and created directories under `root`, each
+    once, leaving out anything inside a directory already taken, and paths
+    whose stat data is still what the last pass left (`settled`).
+    """
+    top = root.resolve()
+    found: set[Path] = set()
+    for created, name in changes:
+        try:
+            st = os.lstat(name)
+        except OSError:
+            continue
+        if settled.get(name) == (st.st_ino, st.st_size, st.st_mtime_ns):
+            continue
+        settled.pop(name, None)
+        if not (stat.S_ISREG(st.st_mode) or (created and stat.S_ISDIR(st.st_mode))):
+            continue
+        path = Path(name)
+        if path != top and top in path.parents:
+            found.add(root / path.relative_to(top))
+    dirs: set[Path] = set()
+    out: list[Path] = []
+    for path in sorted(found):
+        if not dirs.intersection(path.parents):
+            out.append(path)
+            dirs.add(path)
+    return out
 
-import argparse
-import os
-import re
-import sys
-from dataclasses import dataclass
-from pathlib import Path
 
+def _settle(paths: Sequence[Path], moved: dict[str, str], settled: dict[str, _FileSig]) -> None:
+    """Record the stat data a pass left on `paths` (wherever they moved) and below."""
+    for path in paths:
+        final = Path(moved.get(str(path), path)).resolve()
+        found = [final]
+        if final.is_dir():
+            for dirpath, dirnames, filenames in os.walk(final):
+                found += [Path(dirpath, n) for n in dirnames + filenames]
+        for p in found:
+            try:
+                st = os.lstat(p)
+            except OSError:
+                continue
+            settled[str(p)] = (st.st_ino, st.st_size, st.st_mtime_ns)
 
-@dataclass(frozen=True)
-class Stats:
-    renamed_paths: int = 0
-    edited_files: int = 0
-    skipped_binary_or_nonutf8: int = 0
-    rename_collisions: int = 0
 
+# watchfiles' grouping step: a burst ends after this long without events.
+_WATCH_STEP_MS = 50
 
-def _compile_fuzzy_old_pattern(old_string: str) -> re.Pattern[str]:
+
+def watch(
+    *,
+    input_path: Path,
+    debounce_ms: int = 1600,
+    on_pass: Callable[[Stats], object] | None = None,
+    events: EventSink | None = None,
+    **options: Unpack[SwitcherooOptions],
+) -> Stats:
     """
-    Regex that matches `old_string` case-insensitively, allowing separators between letters.
+    Run `switcheroo` over the whole tree, then again over whatever is
+    created or modified under it, until interrupted; returns the totals
+    (`merge_stats`). `on_pass` gets the stats of every pass.
 
-    Example: old="fabric"
-      matches: "fabric", "Fabric", "FABRIC", "F-A-B-R-I-C", "fabri_c", "f a b r i c"
-      and matches as substring: "fabricate", "refabricated", "my-fabric-module", etc.
+    Events are grouped until `_WATCH_STEP_MS` pass without one, or for at
+    most `debounce_ms`. `options` go to `switcheroo`, which must not be asked
+    for a manifest, git mode, an output dir or sharding.
     """
-    if not old_string or not old_string.islower():
-        raise ValueError("old_string must be a non-empty lowercase string")
+    try:
+        import watchfiles
+    except ImportError:
+        raise RuntimeError("watch mode needs the watchfiles package") from None
+    rejected = ("manifest", "rebuild_manifest", "git", "output_dir", "shard", "renames_only")
+    for name in rejected:
+        if options.get(name):
+            raise ValueError(f"watch cannot be combined with {name}")
+    if events is None:
+        events = HumanSink(sys.stdout, batch=1)
 
-    sep = r"[-_\s]*"
-    pattern = sep.join(re.escape(ch) for ch in old_string)
-    return re.compile(pattern, flags=re.IGNORECASE)
+    tee = _TeeSink(events)
+    passes = [switcheroo(input_path=input_path, events=tee, **options)]
+    root = Path(tee.moved.get(str(input_path), input_path))
+    if on_pass is not None:
+        on_pass(passes[-1])
 
+    settled: dict[str, _FileSig] = {}
+    for changes in watchfiles.watch(
+        root.resolve(),
+        watch_filter=None,
+        debounce=debounce_ms,
+        step=_WATCH_STEP_MS,
+        raise_interrupt=False,
+    ):
+        created = [
+            (change == watchfiles.Change.added, name)
+            for change, name in changes
+            if change != watchfiles.Change.deleted
+        ]
+        paths = _watched_paths(created, root, settled)
+        if not paths:
+            continue
+        tee.moved.clear()
+        passes.append(switcheroo(input_path=root, only=paths, events=tee, **options))
+        _settle(paths, tee.moved, settled)
+        if on_pass is not None:
+            on_pass(passes[-1])
+    return merge_stats(passes)
 
-def _styled_replacement(matched: str, new_string: str) -> str:
-    """
-    Decide replacement casing based on matched span, ignoring separators.
 
-    Rules:
-    - If all cased letters in match are upper -> NEW.upper()
-    - Else if first cased letter is upper -> New.capitalize()
-    - Else -> new.lower()
-    """
-    if not new_string or not new_string.islower():
-        raise ValueError("new_string must be a non-empty lowercase string")
+# Bump on any incompatible change to the plan records.
+_PLAN_VERSION = 1
 
-    letters = [c for c in matched if c.isalpha()]
-    cased = [c for c in letters if c.isupper() or c.islower()]
 
-    if not cased:
-        return new_string.lower()
+def write_plan(
+    *,
+    plan_path: Path,
+    input_path: Path,
+    events: EventSink | None = None,
+    **options: Unpack[SwitcherooOptions],
+) -> Stats:
+    """
+    Run `switcheroo` without modifying anything, writing its actions to
+    `plan_path` as NDJSON, one record per line:
 
-    if all(c.isupper() for c in cased):
-        return new_string.upper()
+    - ``{"op": "plan", "version", "root", "pairs"}`` header;
+    - ``{"op": "edit", "path", "size", "sha256", "spans"}`` per file to edit,
+      with `spans` as ``[start, end, replacement]`` byte offsets of the
+      original contents;
+    - ``{"op": "rename", "kind", "path", "to"}`` per rename, bottom-up, with
+      `path` relative to the root as it is right before that rename
+      (``"."`` for the root itself) and `to` the new base name;
+    - ``{"op": "end", "actions"}`` trailer, so a truncated plan is rejected.
+    """
+    with plan_path.open("w", encoding="utf-8") as out:
 
-    first_cased = cased[0]
-    if first_cased.isupper():
-        return new_string[:1].upper() + new_string[1:].lower()
+        def emit(record: dict[str, object]) -> None:
+            out.write(json.dumps(record, separators=(",", ":")) + "\n")
 
-    return new_string.lower()
+        return switcheroo(input_path=input_path, plan=emit, events=events, **options)
 
 
-def _replace_in_text(text: str, pat: re.Pattern[str], new_string: str) -> tuple[str, bool]:
-    def repl(m: re.Match[str]) -> str:
-        return _styled_replacement(m.group(0), new_string)
+def _read_plan(plan_path: Path) -> tuple[Path, list[dict[str, Any]]]:
+    """Root and action records of a complete plan written by `write_plan`."""
+    with plan_path.open(encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records or records[0].get("op") != "plan":
+        raise ValueError(f"{plan_path}: not a switcheroo plan")
+    if records[0].get("version") != _PLAN_VERSION:
+        raise ValueError(f"{plan_path}: unsupported plan version {records[0].get('version')!r}")
+    actions = records[1:-1]
+    if len(records) < 2 or records[-1] != {"op": "end", "actions": len(actions)}:
+        raise ValueError(f"{plan_path}: truncated plan")
+    return Path(str(records[0]["root"])), actions
 
-    new_text, n = pat.subn(repl, text)
-    return new_text, (n > 0)
 
+def _copy_bytes(src: BinaryIO, dst: BinaryIO, n: int) -> None:
+    while n > 0:
+        chunk = src.read(min(n, _STREAM_CHUNK_SIZE))
+        if not chunk:
+            raise OSError(errno.EIO, "file shrank while applying plan")
+        dst.write(chunk)
+        n -= len(chunk)
 
-def _read_utf8_text(path: Path) -> str | None:
-    try:
-        return path.read_text(encoding="utf-8-sig")
-    except (UnicodeDecodeError, OSError):
-        return None
 
+def _apply_edit(
+    fpath: Path,
+    sha256: str,
+    spans: Sequence[_Span],
+    stream_threshold: int,
+    syscalls: dict[str, int],
+) -> bool:
+    """
+    Splice `spans` into `fpath` if its contents still hash to `sha256`.
+    Returns False, leaving the file alone, if it changed since planning (or
+    since the run that journaled it).
+    """
+    _count(syscalls, "open")
+    fd = os.open(fpath, _OPEN_FLAGS)
+    with open(fd, "rb") as src:
+        _count(syscalls, "stat")
+        st = os.fstat(fd)
+        if st.st_size < stream_threshold:
+            data = src.read()
+            if hashlib.sha256(data).hexdigest() != sha256:
+                return False
+            _count(syscalls, "open")
+            fpath.write_bytes(_splice(data, spans))
+            return True
 
-def _write_utf8_text(path: Path, text: str) -> None:
-    path.write_text(text, encoding="utf-8")
+        if hashlib.file_digest(src, "sha256").hexdigest() != sha256:
+            return False
+        src.seek(0)
+        tmp_fd, tmp_name = tempfile.mkstemp(
+            dir=fpath.parent, prefix=f".{fpath.name}.", suffix=".switcheroo"
+        )
+        _count(syscalls, "open")
+        tmp = Path(tmp_name)
+        try:
+            with open(tmp_fd, "wb") as dst:
+                pos = 0
+                for start, end, replacement in spans:
+                    _copy_bytes(src, dst, start - pos)
+                    dst.write(replacement.encode("utf-8"))
+                    src.seek(end)
+                    pos = end
+                shutil.copyfileobj(src, dst, _STREAM_CHUNK_SIZE)
+                dst.flush()
+                os.fsync(dst.fileno())
+            _count(syscalls, "chmod")
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            _count(syscalls, "rename")
+            os.replace(tmp, fpath)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+    return True
 
 
-def switcheroo(
+def apply_plan(
+    plan_path: Path,
     *,
-    input_path: Path,
-    old_string: str,
-    new_string: str,
-    dry_run: bool = False,
+    stream_threshold: int = DEFAULT_STREAM_THRESHOLD,
+    events: EventSink | None = None,
 ) -> Stats:
-    if not input_path.exists():
-        raise FileNotFoundError(str(input_path))
-    if not input_path.is_dir():
-        raise NotADirectoryError(str(input_path))
-    if not new_string or not new_string.islower():
-        raise ValueError("new_string must be a non-empty lowercase string")
+    """
+    Execute a plan from `write_plan` without re-running the matcher.
 
-    pat = _compile_fuzzy_old_pattern(old_string)
+    Each edit is applied only if the file still has the planned SHA-256, and
+    each rename only if its source exists and its target does not (checked
+    atomically where the kernel can, as in a live run); anything else is
+    reported to `events` and left alone.
+    """
+    if events is None:
+        events = HumanSink(sys.stdout, batch=1)
+    root, actions = _read_plan(plan_path)
+    if not root.is_dir():
+        raise NotADirectoryError(str(root))
 
     renamed = 0
     edited = 0
-    skipped = 0
     collisions = 0
+    stale = 0
+    syscalls: dict[str, int] = {}
+    for action in actions:
+        op, rel = action["op"], str(action["path"])
+        if op == "edit":
+            fpath = root / rel
+            spans = [(int(start), int(end), str(repl)) for start, end, repl in action["spans"]]
+            try:
+                ok = _apply_edit(fpath, str(action["sha256"]), spans, stream_threshold, syscalls)
+            except OSError as e:
+                events.emit("stale", action="edit", path=str(fpath), reason=str(e.strerror or e))
+                stale += 1
+                continue
+            if not ok:
+                events.emit("stale", action="edit", path=str(fpath), reason="changed since planned")
+                stale += 1
+                continue
+            edited += 1
+            events.emit("edit", path=str(fpath))
+        elif op == "rename":
+            kind = str(action["kind"])
+            old_path = root if kind == "root" else root / rel
+            new_path = old_path.parent / str(action["to"])
+            _count(syscalls, "stat")
+            if not os.path.lexists(old_path):
+                events.emit(
+                    "stale", action="rename", kind=kind, path=str(old_path), reason="missing"
+                )
+                stale += 1
+                continue
+            with closing(_DirHandle(old_path.parent, syscalls)) as handle:
+                moved = handle.rename(old_path.name, new_path.name)
+            if not moved:
+                events.emit("collision", kind=kind, src=str(old_path), dst=str(new_path))
+                collisions += 1
+                continue
+            renamed += 1
+            events.emit("rename", kind=kind, src=str(old_path), dst=str(new_path))
+        else:
+            raise ValueError(f"{plan_path}: unknown plan op {op!r}")
+    events.flush()
 
-    # Bottom-up: rename children before parents so traversal isn't disrupted.
-    for root, dirnames, filenames in os.walk(input_path, topdown=False, followlinks=False):
-        root_path = Path(root)
+    return Stats(
+        renamed_paths=renamed,
+        edited_files=edited,
+        rename_collisions=collisions,
+        syscalls=dict(sorted(syscalls.items())),
+        stale_plan_entries=stale,
+    )
 
-        # 1) Edit file contents first (paths stable).
-        for fname in filenames:
-            fpath = root_path / fname
-            if fpath.is_symlink():
-                continue
 
-            text = _read_utf8_text(fpath)
-            if text is None:
-                skipped += 1
-                continue
+# Bump on any incompatible change to the journal records.
+_JOURNAL_VERSION = 1
 
-            new_text, changed = _replace_in_text(text, pat, new_string)
-            if changed:
-                edited += 1
-                if not dry_run:
-                    _write_utf8_text(fpath, new_text)
 
-        # 2) Rename files (after content edits).
-        for fname in filenames:
-            old_path = root_path / fname
-            if old_path.is_symlink():
-                continue
+def _read_journal(journal_path: Path) -> tuple[Path, list[dict[str, Any]]]:
+    """Root and change records of a journal, complete or cut short."""
+    with journal_path.open(encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    records: list[dict[str, Any]] = []
+    for i, line in enumerate(lines):
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # Only the very last record may have been half-written.
+            if i < len(lines) - 1:
+                raise ValueError(f"{journal_path}:{i + 1}: corrupt journal record") from None
+    if not records or records[0].get("op") != "journal":
+        raise ValueError(f"{journal_path}: not a switcheroo journal")
+    if records[0].get("version") != _JOURNAL_VERSION:
+        raise ValueError(
+            f"{journal_path}: unsupported journal version {records[0].get('version')!r}"
+        )
+    changes = records[1:]
+    if changes and changes[-1].get("op") == "end":
+        changes.pop()
+    return Path(str(records[0]["root"])), changes
 
-            new_name, changed = _replace_in_text(fname, pat, new_string)
-            if not changed or new_name == fname:
-                continue
 
-            new_path = root_path / new_name
-            if new_path.exists():
-                collisions += 1
-                print(f"[collision] skip rename file: {old_path} -> {new_path}")
-                continue
+def undo_journal(
+    journal_path: Path,
+    *,
+    stream_threshold: int = DEFAULT_STREAM_THRESHOLD,
+    events: EventSink | None = None,
+) -> Stats:
+    """
+    Revert the run that wrote `journal_path` (see `switcheroo`), last change
+    first, touching only the paths it recorded.
 
-            renamed += 1
-            print(f"[rename] file: {old_path} -> {new_path}")
-            if not dry_run:
-                old_path.rename(new_path)
+    Each edit is reverted only if the file still has the SHA-256 the run
+    left it with, and each rename only if its target still exists and its
+    old name is free (checked atomically where the kernel can); anything
+    else is reported to `events` and left alone.
+    """
+    if events is None:
+        events = HumanSink(sys.stdout, batch=1)
+    root, changes = _read_journal(journal_path)
 
-        # 3) Rename directories in this root (still bottom-up overall).
-        for dname in dirnames:
-            old_dir = root_path / dname
-            if old_dir.is_symlink():
+    renamed = 0
+    edited = 0
+    collisions = 0
+    stale = 0
+    syscalls: dict[str, int] = {}
+    for change in reversed(changes):
+        op, rel = change["op"], str(change["path"])
+        if op == "edit":
+            fpath = root / rel
+            spans = [
+                (int(offset), int(offset) + _utf8_len(str(new)), str(old))
+                for offset, old, new in change["patches"]
+            ]
+            try:
+                ok = _apply_edit(fpath, str(change["sha256"]), spans, stream_threshold, syscalls)
+            except OSError as e:
+                events.emit("stale", action="edit", path=str(fpath), reason=str(e.strerror or e))
+                stale += 1
                 continue
-
-            new_dname, changed = _replace_in_text(dname, pat, new_string)
-            if not changed or new_dname == dname:
+            if not ok:
+                events.emit(
+                    "stale", action="edit", path=str(fpath), reason="not as the run left it"
+                )
+                stale += 1
                 continue
-
-            new_dir = root_path / new_dname
-            if new_dir.exists():
+            edited += 1
+            events.emit("edit", path=str(fpath))
+        elif op == "rename":
+            kind = str(change["kind"])
+            old_path = root if kind == "root" else root / rel
+            new_path = old_path.parent / str(change["to"])
+            _count(syscalls, "stat")
+            if not os.path.lexists(new_path):
+                events.emit(
+                    "stale", action="rename", kind=kind, path=str(new_path), reason="missing"
+                )
+                stale += 1
+                continue
+            with closing(_DirHandle(new_path.parent, syscalls)) as handle:
+                moved = handle.rename(new_path.name, old_path.name)
+            if not moved:
+                events.emit("collision", kind=kind, src=str(new_path), dst=str(old_path))
                 collisions += 1
-                print(f"[collision] skip rename dir: {old_dir} -> {new_dir}")
                 continue
-
             renamed += 1
-            print(f"[rename] dir:  {old_dir} -> {new_dir}")
-            if not dry_run:
-                old_dir.rename(new_dir)
-
-    # Rename the root directory name itself (optional, but you asked "including root directory given").
-    parent = input_path.parent
-    root_name = input_path.name
-    new_root_name, changed = _replace_in_text(root_name, pat, new_string)
-    if changed and new_root_name != root_name:
-        new_root = parent / new_root_name
-        if new_root.exists():
-            collisions += 1
-            print(f"[collision] skip rename root: {input_path} -> {new_root}")
+            events.emit("rename", kind=kind, src=str(new_path), dst=str(old_path))
         else:
-            renamed += 1
-            print(f"[rename] root: {input_path} -> {new_root}")
-            if not dry_run:
-                input_path.rename(new_root)
+            raise ValueError(f"{journal_path}: unknown journal op {op!r}")
+    events.flush()
 
     return Stats(
         renamed_paths=renamed,
         edited_files=edited,
-        skipped_binary_or_nonutf8=skipped,
         rename_collisions=collisions,
+        syscalls=dict(sorted(syscalls.items())),
+        stale_plan_entries=stale,
     )
 
 
-def _build_parser() -> argparse.ArgumentParser:
+def _build_parser(command: str | None = None) -> argparse.ArgumentParser:
+    """Parser for a plain run, or for `plan` (same options, plus --output)."""
+    prog = Path(sys.argv[0]).name + (f" {command}" if command else "")
     p = argparse.ArgumentParser(
-        description="Recursive case-preserving replace in dir/file names + UTF-8 text contents."
+        prog=prog,
+        description="Recursive case-preserving replace in dir/file names + UTF-8 text contents.",
+        epilog=None
+        if command
+        else f"Also: '{prog} plan -o PLAN ...' to write a plan, '{prog} apply PLAN' to run it, "
+        f"'{prog} undo JOURNAL' to revert a --journal run, "
+        f"'{prog} merge-stats FILE...' to sum --stats-json files.",
     )
     p.add_argument("input_path", type=Path, help="Root directory to process (inclusive).")
-    p.add_argument("old_string", type=str, help="Lowercase old string to replace (e.g. 'fabric').")
-    p.add_argument("new_string", type=str, help="Lowercase new string (e.g. 'apollo').")
-    p.add_argument("--dry-run", action="store_true", help="Print actions, do not modify filesystem.")
+    p.add_argument(
+        "old_string", type=str, nargs="?", help="Lowercase old string to replace (e.g. 'fabric')."
+    )
+    p.add_argument("new_string", type=str, nargs="?", help="Lowercase new string (e.g. 'apollo').")
+    p.add_argument(
+        "--mapping",
+        type=Path,
+        default=None,
+        metavar="FILE",
+        help="File of 'old<TAB>new' lines, all replaced in the same single pass.",
+    )
+    p.add_argument(
+        "--strict",
+        action="store_true",
+        help="Only match the exact spelling (any case), not with separators between letters.",
+    )
+    p.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Skip paths matching this gitignore-style pattern (repeatable).",
+    )
+    p.add_argument(
+        "--git",
+        action="store_true",
+        help="List tracked files from the git index instead of walking; skip known-clean blobs.",
+    )
+    p.add_argument(
+        "--gitignore",
+        action="store_true",
+        help="Also skip whatever .gitignore files in the tree ignore, and .git directories.",
+    )
+    if command == "plan":
+        p.add_argument(
+            "-o",
+            "--output",
+            type=Path,
+            required=True,
+            metavar="PLAN",
+            help="Write the NDJSON plan here; nothing else is modified.",
+        )
+    else:
+        p.add_argument(
+            "--dry-run", action="store_true", help="Print actions, do not modify filesystem."
+        )
+        p.add_argument(
+            "--output-dir",
+            type=Path,
+            default=None,
+            metavar="DIR",
+            help="Build the renamed tree in DIR (new or empty), leaving input_path untouched.",
+        )
+        p.add_argument(
+            "--link-mode",
+            choices=_LINK_MODES,
+            default="hardlink",
+            help="How --output-dir gets files without a match (copy if that fails; "
+            "default: hardlink).",
+        )
+        p.add_argument(
+            "--shard",
+            type=_parse_shard,
+            default=None,
+            metavar="I/N",
+            help="Only edit shard I of N (1-based, by path hash); rename nothing.",
+        )
+        p.add_argument(
+            "--renames-only",
+            action="store_true",
+            help="Only rename, reading no file: the final step after all --shard runs.",
+        )
+        p.add_argument(
+            "--journal",
+            type=Path,
+            default=None,
+            metavar="FILE",
+            help="Record every change in FILE (new, outside the tree; needs --jobs 1) "
+            "before making it, for 'undo FILE'.",
+        )
+        p.add_argument(
+            "--watch",
+            action="store_true",
+            help="After the first pass, keep processing files as they are created or modified.",
+        )
+        p.add_argument(
+            "--debounce",
+            type=int,
+            default=1600,
+            metavar="MS",
+            help="--watch: longest time to gather a burst of events into one pass (default: 1600).",
+        )
+    p.add_argument(
+        "--include-ext",
+        action="append",
+        default=[],
+        metavar="EXT",
+        help="Only look at the contents of files with this extension (repeatable, e.g. py).",
+    )
+    p.add_argument(
+        "--exclude-ext",
+        action="append",
+        default=[],
+        metavar="EXT",
+        help="Never look at the contents of files with this extension (repeatable).",
+    )
+    p.add_argument(
+        "--max-size",
+        type=int,
+        default=0,
+        metavar="BYTES",
+        help="Skip the contents of files larger than this (default: 0, no limit).",
+    )
+    p.add_argument(
+        "--sniff-bytes",
+        type=int,
+        default=DEFAULT_SNIFF_BYTES,
+        metavar="BYTES",
+        help="Skip files with a NUL byte or invalid UTF-8 this early without reading the rest "
+        "(default: 8192; 0 reads every file whole).",
+    )
+    p.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help="Match every file on its own, even when its bytes were already seen.",
+    )
+    p.add_argument("--stats", action="store_true", help="Print detailed run statistics at the end.")
+    p.add_argument(
+        "--stats-json",
+        type=Path,
+        default=None,
+        metavar="FILE",
+        help="Write all run statistics (timings, bytes, ...) as JSON to FILE ('-' for stdout).",
+    )
+    _add_log_arguments(p)
+    p.add_argument(
+        "--manifest",
+        action="store_true",
+        help=f"Skip files recorded as match-free in ROOT/{MANIFEST_NAME}, and update it.",
+    )
+    p.add_argument(
+        "--rebuild-manifest",
+        action="store_true",
+        help="Like --manifest, but ignore existing entries and rebuild them from scratch.",
+    )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Worker processes for the content phase (0 = one per CPU, default: 1).",
+    )
+    p.add_argument(
+        "--walk-threads",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Threads listing directories, for very wide trees on slow filesystems (default: 1).",
+    )
+    p.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Threads reading files ahead of the content phase, for high-latency "
+        "filesystems (needs -j 1; default: 0, off).",
+    )
+    p.add_argument(
+        "--prefetch-depth",
+        type=int,
+        default=0,
+        metavar="FILES",
+        help="Most files held read ahead by --prefetch (default: 4 per thread).",
+    )
+    p.add_argument(
+        "--stream-threshold",
+        type=int,
+        default=DEFAULT_STREAM_THRESHOLD,
+        metavar="BYTES",
+        help="Rewrite files at least this large in constant memory (default: 64 MiB).",
+    )
+    p.add_argument(
+        "--mmap-threshold",
+        type=int,
+        default=DEFAULT_MMAP_THRESHOLD,
+        metavar="BYTES",
+        help="Rewrite ASCII files at least this large from a memory map, without decoding "
+        "them, into a new file that replaces the old one (a new inode, like streamed "
+        "files; default: 1 MiB; 0 = never).",
+    )
+    p.add_argument(
+        "--max-match-len",
+        type=int,
+        default=DEFAULT_MAX_MATCH_LEN,
+        metavar="CHARS",
+        help="Longest match (separators included) guaranteed on the streaming path.",
+    )
     return p
 
 
-def main(argv: list[str] | None = None) -> int:
-    args = _build_parser().parse_args(argv)
+def _parse_shard(text: str) -> tuple[int, int]:
+    i, sep, n = text.partition("/")
     try:
-        stats = switcheroo(
-            input_path=args.input_path,
-            old_string=args.old_string,
-            new_string=args.new_string,
-            dry_run=bool(args.dry_run),
-        )
-    except Exception as e:
+        shard = (int(i), int(n))
+    except ValueError:
+        shard = (0, 0)
+    if not sep or not 1 <= shard[0] <= shard[1]:
+        raise argparse.ArgumentTypeError(f"expected I/N with 1 <= I <= N, got {text!r}")
+    return shard
+
+
+def _add_log_arguments(p: argparse.ArgumentParser) -> None:
+    p.add_argument(
+        "--log-format",
+        choices=("human", "ndjson"),
+        default="human",
+        help="Per-action log lines: '[rename] ...' text or one JSON object each (default: human).",
+    )
+    p.add_argument(
+        "--log-file",
+        type=Path,
+        default=None,
+        metavar="FILE",
+        help="Write the action log here instead of stdout.",
+    )
+    p.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Do not log individual actions, only the summary.",
+    )
+
+
+def _make_sink(args: argparse.Namespace) -> EventSink:
+    if args.quiet:
+        return QuietSink()
+    sink_type = NdjsonSink if args.log_format == "ndjson" else HumanSink
+    if args.log_file is None:
+        return sink_type(sys.stdout)
+    return sink_type(args.log_file.open("w", encoding="utf-8"), close_stream=True)
+
+
+def _finish(events: EventSink, stats: Stats, summary: Sequence[str], show_stats: bool) -> int:
+    """Print the summary lines (a final "done" event in NDJSON mode) and close `events`."""
+    if isinstance(events, NdjsonSink):
+        events.emit("done", **dataclasses.asdict(stats), events=dict(events.counts))
+    else:
+        for line in summary:
+            print(line)
+        if show_stats:
+            for name, n in sorted(events.counts.items()):
+                print(f"[stats] events.{name}={n}")
+    events.close()
+    return 0
+
+
+# The phases `_PhaseClock` times in `switcheroo`, in order.
+_PHASES = ("walk", "content", "rename")
+
+
+def _report_pass(events: EventSink, stats: Stats) -> None:
+    events.emit(
+        "pass",
+        renamed=stats.renamed_paths,
+        edited=stats.edited_files,
+        collisions=stats.rename_collisions,
+        seconds=round(sum(stats.phase_seconds.get(p, 0.0) for p in _PHASES), 3),
+    )
+    events.flush()
+
+
+def _write_stats_json(path: Path, stats: Stats) -> None:
+    text = json.dumps(dataclasses.asdict(stats), indent=2) + "\n"
+    if str(path) == "-":
+        sys.stdout.write(text)
+    else:
+        path.write_text(text, encoding="utf-8")
+
+
+def _build_apply_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        prog=Path(sys.argv[0]).name + " apply",
+        description="Execute a plan written by 'plan', without rescanning the tree.",
+    )
+    p.add_argument("plan", type=Path, help="NDJSON plan file.")
+    p.add_argument("--stats", action="store_true", help="Print detailed run statistics at the end.")
+    _add_log_arguments(p)
+    p.add_argument(
+        "--stream-threshold",
+        type=int,
+        default=DEFAULT_STREAM_THRESHOLD,
+        metavar="BYTES",
+        help="Rewrite files at least this large in constant memory (default: 64 MiB).",
+    )
+    return p
+
+
+def _main_replay(args: argparse.Namespace, replay: Callable[[EventSink], Stats]) -> int:
+    """
+    Run `replay` (`apply_plan` or `undo_journal`) with the sink `args` ask
+    for and report it; an unreadable or malformed file is an error.
+    """
+    events = _make_sink(args)
+    try:
+        stats = replay(events)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        events.close()
         print(f"[error] {type(e).__name__}: {e}", file=sys.stderr)
         return 1
 
-    print(
-        f"[done] renamed={stats.renamed_paths} edited_files={stats.edited_files} "
-        f"skipped_nonutf8_or_binary={stats.skipped_binary_or_nonutf8} collisions={stats.rename_collisions}"
+    summary = [
+        (
+            f"[done] renamed={stats.renamed_paths} edited_files={stats.edited_files} "
+            f"collisions={stats.rename_collisions} stale={stats.stale_plan_entries}"
+        )
+    ]
+    if args.stats:
+        summary += [f"[stats] syscalls.{name}={n}" for name, n in stats.syscalls.items()]
+    return _finish(events, stats, summary, args.stats)
+
+
+def _main_apply(argv: list[str]) -> int:
+    args = _build_apply_parser().parse_args(argv)
+    return _main_replay(
+        args,
+        lambda events: apply_plan(args.plan, stream_threshold=args.stream_threshold, events=events),
+    )
+
+
+def _main_undo(argv: list[str]) -> int:
+    p = argparse.ArgumentParser(
+        prog=Path(sys.argv[0]).name + " undo",
+        description="Revert the changes recorded by a --journal run, last first.",
     )
+    p.add_argument("journal", type=Path, help="NDJSON journal file.")
+    p.add_argument("--stats", action="store_true", help="Print detailed run statistics at the end.")
+    _add_log_arguments(p)
+    p.add_argument(
+        "--stream-threshold",
+        type=int,
+        default=DEFAULT_STREAM_THRESHOLD,
+        metavar="BYTES",
+        help="Rewrite files at least this large in constant memory (default: 64 MiB).",
+    )
+    args = p.parse_args(argv)
+    return _main_replay(
+        args,
+        lambda events: undo_journal(
+            args.journal, stream_threshold=args.stream_threshold, events=events
+        ),
+    )
+
+
+def _main_merge_stats(argv: list[str]) -> int:
+    p = argparse.ArgumentParser(
+        prog=Path(sys.argv[0]).name + " merge-stats",
+        description="Sum the --stats-json files of several runs (e.g. one per --shard).",
+    )
+    p.add_argument("inputs", type=Path, nargs="+", metavar="FILE", help="--stats-json output.")
+    p.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=Path("-"),
+        metavar="FILE",
+        help="Write the merged JSON here (default: stdout).",
+    )
+    args = p.parse_args(argv)
+    names = {f.name for f in dataclasses.fields(Stats)}
+    runs: list[Stats] = []
+    try:
+        for path in args.inputs:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            runs.append(Stats(**{k: v for k, v in data.items() if k in names}))
+    except (OSError, ValueError, TypeError) as e:
+        print(f"[error] {type(e).__name__}: {e}", file=sys.stderr)
+        return 1
+    _write_stats_json(args.output, merge_stats(runs))
     return 0
 
 
+def main(argv: list[str] | None = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv and argv[0] in ("plan", "apply", "merge-stats", "undo") else None
+    if command == "apply":
+        return _main_apply(argv[1:])
+    if command == "undo":
+        return _main_undo(argv[1:])
+    if command == "merge-stats":
+        return _main_merge_stats(argv[1:])
+
+    parser = _build_parser(command)
+    args = parser.parse_args(argv[1:] if command else argv)
+    if args.mapping is None and (args.old_string is None or args.new_string is None):
+        parser.error("old_string and new_string are required unless --mapping is given")
+    if getattr(args, "watch", False) and getattr(args, "journal", None) is not None:
+        parser.error("--watch cannot be combined with --journal")
+    events = _make_sink(args)
+    try:
+        options: SwitcherooOptions = {
+            "old_string": args.old_string or "",
+            "new_string": args.new_string or "",
+            "mapping": load_mapping(args.mapping) if args.mapping is not None else [],
+            "strict": bool(args.strict),
+            "dry_run": bool(getattr(args, "dry_run", False)),
+            "jobs": args.jobs,
+            "stream_threshold": args.stream_threshold,
+            "max_match_len": args.max_match_len,
+            "manifest": bool(args.manifest),
+            "rebuild_manifest": bool(args.rebuild_manifest),
+            "exclude": args.exclude,
+            "gitignore": bool(args.gitignore),
+            "git": bool(args.git),
+            "output_dir": getattr(args, "output_dir", None),
+            "link_mode": getattr(args, "link_mode", "hardlink"),
+            "dedup": not args.no_dedup,
+            "shard": getattr(args, "shard", None),
+            "renames_only": bool(getattr(args, "renames_only", False)),
+            "include_ext": args.include_ext,
+            "exclude_ext": args.exclude_ext,
+            "max_size": args.max_size,
+            "sniff_bytes": args.sniff_bytes,
+            "prefetch": args.prefetch,
+            "prefetch_depth": args.prefetch_depth,
+            "walk_threads": args.walk_threads,
+            "mmap_threshold": args.mmap_threshold,
+        }
+        if command == "plan":
+            stats = write_plan(
+                plan_path=args.output, input_path=args.input_path, events=events, **options
+            )
+        elif args.watch:
+            stats = watch(
+                input_path=args.input_path,
+                debounce_ms=args.debounce,
+                on_pass=functools.partial(_report_pass, events),
+                events=events,
+                **options,
+            )
+        else:
+            stats = switcheroo(
+                input_path=args.input_path,
+                journal_path=getattr(args, "journal", None),
+                events=events,
+                **options,
+            )
+    except Exception as e:
+        events.close()
+        print(f"[error] {type(e).__name__}: {e}", file=sys.stderr)
+        return 1
+
+    summary = [
+        (
+            f"[done] renamed={stats.renamed_paths} edited_files={stats.edited_files} "
+            f"skipped_nonutf8_or_binary={stats.skipped_binary_or_nonutf8} "
+            f"collisions={stats.rename_collisions} "
+            f"prefilter_rejected={stats.prefilter_rejected_files} "
+            f"prefilter_saved_bytes={stats.prefilter_saved_bytes} streamed={stats.streamed_files}"
+        )
+    ]
+    if args.mapping is not None:
+        summary += [f"[pair] {pair}: {n}" for pair, n in stats.matches_by_pair.items()]
+    if stats.output_files:
+        summary.append(
+            "[output] " + " ".join(f"{how}={n}" for how, n in stats.output_files.items())
+        )
+    if args.stats:
+        summary += [
+            f"[stats] manifest_skipped_files={stats.manifest_skipped_files}",
+            f"[stats] blob_skipped_files={stats.blob_skipped_files}",
+            f"[stats] shard_skipped_files={stats.shard_skipped_files}",
+            "[stats] skipped_files "
+            + (" ".join(f"{why}={n}" for why, n in stats.skipped_files.items()) or "none"),
+            (
+                f"[stats] pruned_dirs={stats.pruned_dirs} pruned_files={stats.pruned_files} "
+                f"walk_seconds={stats.walk_seconds:.3f}"
+            ),
+            (
+                f"[stats] dedup_hits={stats.dedup_hits} dedup_misses={stats.dedup_misses} "
+                f"dedup_hit_rate={stats.dedup_hit_rate:.1%} dedup_hit_bytes={stats.dedup_hit_bytes}"
+            ),
+            (
+                f"[stats] mmap_files={stats.mmap_files} "
+                f"mmap_bytes_copied={stats.mmap_bytes_copied} "
+                f"mmap_bytes_touched={stats.mmap_bytes_touched}"
+            ),
+        ]
+        summary += [f"[stats] syscalls.{name}={n}" for name, n in stats.syscalls.items()]
+        for name, seconds in stats.phase_seconds.items():
+            cpu = stats.phase_cpu_seconds.get(name)
+            summary.append(
+                f"[stats] phase.{name} wall={seconds:.3f}s"
+                + (f" cpu={cpu:.3f}s" if cpu is not None else "")
+            )
+        summary.append(
+            f"[stats] bytes_read={stats.bytes_read} bytes_written={stats.bytes_written} "
+            f"files_per_second={stats.files_per_second:.0f}"
+        )
+        summary += [
+            f"[stats] matches.ext{ext or '(none)'}={n}"
+            for ext, n in stats.matches_by_extension.items()
+        ]
+        summary += [f"[stats] largest {size} {path}" for path, size in stats.largest_files]
+    if args.stats_json is not None:
+        _write_stats_json(args.stats_json, stats)
+    return _finish(events, stats, summary, args.stats)
+
+
 if __name__ == "__main__":
     raise SystemExit(main())
 
@@ -529,4 +4486,4 @@ def main(argv: list[str] | None = None) -> int:
 
 if __name__ == "__main__":
     raise SystemExit(main())
-"""
\ No newline at end of file
+"""
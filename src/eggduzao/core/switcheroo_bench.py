@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# switcheroo_bench.py
+# Benchmarks switcheroo's internals head to head, so it reaches into them.
+# pyright: reportPrivateUsage=false
+"""
+Micro-benchmarks for switcheroo.py.
+
+Run from anywhere; `switcheroo` is imported from this script's directory:
+
+    python switcheroo_bench.py matcher
+    python switcheroo_bench.py matcher --old fabric --size-mb 8 --repeat 5
+    python switcheroo_bench.py replace --size-mb 4
+    python switcheroo_bench.py renames --depth 20 --width 200
+    python switcheroo_bench.py tree --save-baseline baseline.json
+    python switcheroo_bench.py tree --baseline baseline.json --threshold 0.1
+    python switcheroo_bench.py prefetch --latency-ms 2 --threads 2,4,8,16
+
+matcher
+-------
+Throughput (MB/s of UTF-8 input) of `_replace_in_text` with the linear
+(possessive) pattern from `_compile_fuzzy_old_pattern` against the plain
+backtracking pattern, on ordinary prose and on adversarial separator-heavy
+inputs: long whitespace/underscore runs after a first letter, and spelled-out
+near misses such as "f_a_b_r_i_" that fail on the very last letter.
+
+replace
+-------
+Replacement throughput on match-dense inputs (a match every few words, in
+every casing), for the engine paths: per-match styling that re-derives the
+casing of `new` on every match (the old `_styled_replacement`, kept here as
+the baseline), the precomputed casing variants (`_Replacer`), and
+`--strict`, both through its regex and through the `str.find` loops of
+`_replace_literals` that ASCII text takes.
+
+renames
+-------
+Rename phase on a synthetic chain of `--depth` nested directories, each
+holding `--width` files, every name containing "fabric": `Path.rename` with
+full paths (the kernel walks every component each time) against
+`_DirHandle`, which opens each directory once and renames relative to it.
+
+tree
+----
+End-to-end `switcheroo()` runs, dry and real, over a deterministic synthetic
+tree (`--seed`): `--depth` levels of `--fanout` subdirectories with `--files`
+files each, log-normal file sizes, `--density` matches per KiB, a fraction of
+them spelled with separators ("f-a-b-r-i-c"), plus non-UTF-8 files and
+symlinks. Each run happens in a fresh process on a fresh copy of the tree
+and records best wall time, peak RSS and syscall counts. With `--baseline`,
+any metric worse than the stored one by more than `--threshold` fails the
+run (exit status 1).
+
+prefetch
+--------
+The content phase of dry `switcheroo()` runs over a synthetic tree (as for
+`tree`) with `--latency-ms` added to every `os.open` under it, a local
+stand-in for NFS/FUSE round trips: serial reads against `--prefetch` with
+each of `--threads`, at the default depth or `--depth-per-thread`. Reports
+files per second, the speedup, and how long the main thread still waited.
+"""
+
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import functools
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections.abc import Callable, Generator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from pathlib import Path
+from typing import Any
+
+import switcheroo as sw
+
+
+def _matcher_inputs(old: str, size: int) -> dict[str, str]:
+    """Deterministic inputs of roughly `size` characters each."""
+    head, last = old[:-1], old[-1]
+    near_miss = "_".join(head) + "_" + chr(ord(last) ^ 1) + " "
+    units = {
+        "prose": f"The quick brown fox jumps over the lazy {old} and {old.upper()}ated dog. ",
+        "whitespace-runs": old[0] + " " * 200 + old[1:2] + "\t" * 200 + "x\n",
+        "underscore-runs": old[0].upper() + "_" * 500 + "-" * 500 + ";",
+        "spelled-near-miss": near_miss,
+        "separator-storm": "-".join(head) + " -_ " * 64 + "!",
+    }
+    return {name: unit * max(1, size // len(unit)) for name, unit in units.items()}
+
+
+def _best_seconds(fn: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_matcher(old: str, new: str, size_mb: float, repeat: int) -> None:
+    patterns: dict[str, re.Pattern[str]] = {
+        "backtracking": sw._compile_backtracking_old_pattern(old),
+        "linear": sw._compile_fuzzy_old_pattern(old),
+    }
+    inputs = _matcher_inputs(old, int(size_mb * 1024 * 1024))
+
+    print(f"{'input':<20} {'matcher':<14} {'matches':>9} {'MB/s':>9} {'speedup':>8}")
+    for name, text in inputs.items():
+        mb = len(text.encode("utf-8")) / 1e6
+        baseline = 0.0
+        for label, pat in patterns.items():
+            matches = len(pat.findall(text))
+            rules = dataclasses.replace(sw._compile_rules([(old, new)]), pat=pat)
+            secs = _best_seconds(functools.partial(sw._replace_in_text, text, rules), repeat)
+            rate = mb / secs
+            baseline = baseline or rate
+            print(f"{name:<20} {label:<14} {matches:>9} {rate:>9.1f} {rate / baseline:>7.2f}x")
+
+
+def _legacy_styled_replacement(matched: str, new_string: str) -> str:
+    """Per-match styling as before `_case_style`: two lists, casing rebuilt each time."""
+    letters = [c for c in matched if c.isalpha()]
+    cased = [c for c in letters if c.isupper() or c.islower()]
+    if not cased:
+        return new_string.lower()
+    if all(c.isupper() for c in cased):
+        return new_string.upper()
+    if cased[0].isupper():
+        return new_string[:1].upper() + new_string[1:].lower()
+    return new_string.lower()
+
+
+def _dense_inputs(old: str, size: int) -> dict[str, str]:
+    """Match-dense inputs of roughly `size` characters each."""
+    rnd = random.Random(0)
+    spellings = [old, old.upper(), old.capitalize()]
+    code = " ".join(f"{rnd.choice(spellings)}_{i} = {old}.get({i})\n" for i in range(64))
+    units = {
+        "dense-lower": f"{old} x {old}ated {old}s; ",
+        "dense-mixed": code,
+        "ascii-prose": f"See the {old.capitalize()} docs. The quick brown fox jumps. ",
+        "non-ascii": f"Größe {old.upper()} für {old}é. ",
+    }
+    return {name: unit * max(1, size // len(unit)) for name, unit in units.items()}
+
+
+def bench_replace(old: str, new: str, size_mb: float, repeat: int) -> None:
+    fuzzy = sw._compile_rules([(old, new)])
+    strict = sw._compile_rules([(old, new)], strict=True)
+
+    def legacy(text: str) -> object:
+        return fuzzy.pat.subn(lambda m: _legacy_styled_replacement(m.group(0), new), text)
+
+    engines: dict[str, Callable[[str], object]] = {
+        "per-match": legacy,
+        "variants": lambda text: sw._replace_in_text(text, fuzzy),
+        "strict-regex": lambda text: strict.pat.subn(strict.replacer, text),
+        "strict-find": lambda text: sw._replace_in_text(text, strict),
+    }
+    inputs = _dense_inputs(old, int(size_mb * 1024 * 1024))
+
+    print(f"{'input':<14} {'engine':<14} {'matches':>9} {'MB/s':>9} {'speedup':>8}")
+    for name, text in inputs.items():
+        mb = len(text.encode("utf-8")) / 1e6
+        matches = len(fuzzy.pat.findall(text))
+        baseline = 0.0
+        for label, run in engines.items():
+            secs = _best_seconds(functools.partial(run, text), repeat)
+            rate = mb / secs
+            baseline = baseline or rate
+            print(f"{name:<14} {label:<14} {matches:>9} {rate:>9.1f} {rate / baseline:>7.2f}x")
+
+
+def _make_deep_tree(root: Path, depth: int, width: int) -> None:
+    d = root
+    for level in range(depth):
+        d = d / f"fabric_level_{level:02d}_{'x' * 24}"
+        d.mkdir(parents=True)
+        for i in range(width):
+            (d / f"fabric_file_{i:05d}.txt").touch()
+
+
+def _rename_with_paths(tree: list[sw._DirListing], syscalls: dict[str, int]) -> None:
+    for listing in tree:
+        for name in listing.files + listing.dirs:
+            sw._count(syscalls, "rename")
+            (listing.path / name).rename(listing.path / name.replace("fabric", "apollo"))
+
+
+def _rename_with_dir_fds(tree: list[sw._DirListing], syscalls: dict[str, int]) -> None:
+    for listing in tree:
+        handle = sw._DirHandle(listing.path, syscalls)
+        try:
+            for name in listing.files + listing.dirs:
+                handle.rename(name, name.replace("fabric", "apollo"))
+        finally:
+            handle.close()
+
+
+def bench_renames(depth: int, width: int, repeat: int) -> None:
+    variants: dict[str, Callable[[list[sw._DirListing], dict[str, int]], None]] = {
+        "Path.rename": _rename_with_paths,
+        "dir fd": _rename_with_dir_fds,
+    }
+    print(
+        f"{'renames':<14} {'entries':>8} {'seconds':>9} {'per sec':>10} {'syscalls':>9} {'speedup':>8}"
+    )
+    baseline = 0.0
+    for label, rename in variants.items():
+        best = float("inf")
+        entries = 0
+        syscalls: dict[str, int] = {}
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory(prefix="switcheroo-bench-") as tmp:
+                root = Path(tmp) / "root"
+                _make_deep_tree(root, depth, width)
+                tree = sw._walk_bottom_up(root, {})
+                entries = sum(len(t.files) + len(t.dirs) for t in tree)
+                syscalls = {}
+                t0 = time.perf_counter()
+                rename(tree, syscalls)
+                best = min(best, time.perf_counter() - t0)
+                shutil.rmtree(root)
+        baseline = baseline or best
+        calls = sum(syscalls.values())
+        print(
+            f"{label:<14} {entries:>8} {best:>9.4f} {entries / best:>10.0f} {calls:>9} "
+            f"{baseline / best:>7.2f}x"
+        )
+
+
+_WORDS = ("alpha", "beta", "gamma", "delta", "lorem", "ipsum", "dolor", "amet", "the", "of")
+
+
+def _spelling(rnd: random.Random, old: str, separators: float) -> str:
+    if rnd.random() < separators:
+        return rnd.choice("-_ ").join(old)
+    return rnd.choice((old, old.upper(), old.capitalize()))
+
+
+def _file_contents(rnd: random.Random, old: str, size: int, config: dict[str, float]) -> bytes:
+    if rnd.random() < config["non_utf8"]:
+        return bytes(rnd.getrandbits(8) for _ in range(min(size, 4096))) + b"\xff\xfe" * (size // 8)
+    words: list[str] = []
+    length = 0
+    per_word = config["density"] * 6 / 1024
+    while length < size:
+        if rnd.random() < per_word:
+            word = _spelling(rnd, old, config["separators"])
+        else:
+            word = rnd.choice(_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words).encode("utf-8")
+
+
+def make_tree(root: Path, old: str, config: dict[str, float], seed: int) -> int:
+    """
+    Build the synthetic tree described by `config` under `root`; the same
+    config and seed always give the same tree. Returns the number of files.
+    """
+    rnd = random.Random(seed)
+    count = 0
+    pending = [(root, 0)]
+    while pending:
+        d, level = pending.pop()
+        d.mkdir(parents=True)
+        for i in range(int(config["files"])):
+            name = f"file_{i}.txt"
+            if rnd.random() < 0.3:
+                name = f"{_spelling(rnd, old, config['separators'])}_{i}.txt"
+            size = int(rnd.lognormvariate(0, config["size_sigma"]) * config["size_kb"] * 1024)
+            (d / name).write_bytes(_file_contents(rnd, old, size, config))
+            count += 1
+            if i and rnd.random() < config["symlinks"]:
+                (d / f"link_{i}").symlink_to(name)
+        if level < config["depth"]:
+            for j in range(int(config["fanout"])):
+                sub = f"{old}_{j}" if rnd.random() < 0.3 else f"dir_{j}"
+                pending.append((d / sub, level + 1))
+    return count
+
+
+def _peak_rss_kb() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def _measure_run(tree: str, old: str, new: str, dry_run: bool, jobs: int) -> dict[str, Any]:
+    """One `switcheroo()` run, in a fresh worker process so peak RSS is its own."""
+    with redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        stats = sw.switcheroo(
+            input_path=Path(tree), old_string=old, new_string=new, dry_run=dry_run, jobs=jobs
+        )
+        seconds = time.perf_counter() - t0
+    return {"seconds": seconds, "peak_rss_kb": _peak_rss_kb(), "syscalls": stats.syscalls}
+
+
+def bench_tree(args: argparse.Namespace) -> int:
+    config: dict[str, float] = {
+        "depth": args.depth,
+        "fanout": args.fanout,
+        "files": args.files,
+        "size_kb": args.size_kb,
+        "size_sigma": args.size_sigma,
+        "density": args.density,
+        "non_utf8": args.non_utf8,
+        "symlinks": args.symlinks,
+        "separators": args.separators,
+    }
+    spawn = multiprocessing.get_context("spawn")
+    results: dict[str, dict[str, Any]] = {}
+    with tempfile.TemporaryDirectory(prefix="switcheroo-bench-") as tmp:
+        template = Path(tmp) / "template"
+        n_files = make_tree(template, args.old, config, args.seed)
+        for mode in ("dry-run", "real"):
+            best: dict[str, Any] = {}
+            for _ in range(args.repeat):
+                work = Path(tmp) / "work"
+                shutil.rmtree(work, ignore_errors=True)
+                shutil.copytree(template, work, symlinks=True)
+                with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                    run = pool.submit(
+                        _measure_run, str(work), args.old, args.new, mode == "dry-run", args.jobs
+                    ).result()
+                if not best or run["seconds"] < best["seconds"]:
+                    best = run
+            results[mode] = best
+
+    report = {
+        "config": {**config, "old": args.old, "seed": args.seed, "jobs": args.jobs},
+        "results": results,
+    }
+    print(f"tree: {n_files} files, config {json.dumps(report['config'])}")
+    print(f"{'mode':<8} {'seconds':>9} {'peak RSS KiB':>13} {'syscalls':>9}")
+    for mode, run in results.items():
+        calls = sum(run["syscalls"].values())
+        print(f"{mode:<8} {run['seconds']:>9.3f} {run['peak_rss_kb']:>13} {calls:>9}")
+
+    if args.save_baseline is not None:
+        args.save_baseline.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+        print(f"baseline written to {args.save_baseline}")
+    if args.baseline is None:
+        return 0
+
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    if baseline["config"] != report["config"]:
+        print(f"baseline {args.baseline} was recorded with a different config", file=sys.stderr)
+        return 2
+    failed = False
+    for mode, run in results.items():
+        base = baseline["results"][mode]
+        checks = [("seconds", run["seconds"], base["seconds"])]
+        checks.append(("peak_rss_kb", run["peak_rss_kb"], base["peak_rss_kb"]))
+        checks += [
+            (f"syscalls.{name}", n, base["syscalls"].get(name, 0))
+            for name, n in run["syscalls"].items()
+        ]
+        for metric, value, ref in checks:
+            limit = ref * (1 + args.threshold)
+            if value > limit:
+                failed = True
+                print(
+                    f"REGRESSION {mode} {metric}: {value:.6g} > {ref:.6g} (+{args.threshold:.0%})"
+                )
+    print("FAIL" if failed else "OK")
+    return 1 if failed else 0
+
+
+@contextmanager
+def _open_latency(root: Path, seconds: float) -> Generator[None, None, None]:
+    """Make every `os.open` of a path under `root` take `seconds` longer."""
+    real_open = os.open
+    prefix = str(root)
+
+    def slow_open(path: Any, flags: int, mode: int = 0o777, *, dir_fd: int | None = None) -> int:
+        if str(path).startswith(prefix):
+            time.sleep(seconds)
+        return real_open(path, flags, mode, dir_fd=dir_fd)
+
+    os.open = slow_open
+    try:
+        yield
+    finally:
+        os.open = real_open
+
+
+def bench_prefetch(args: argparse.Namespace) -> None:
+    config: dict[str, float] = {
+        "depth": args.depth,
+        "fanout": 4,
+        "files": args.files,
+        "size_kb": args.size_kb,
+        "size_sigma": 1.0,
+        "density": 0.5,
+        "non_utf8": 0.05,
+        "symlinks": 0.0,
+        "separators": 0.2,
+    }
+    threads = [0] + [int(n) for n in args.threads.split(",")]
+    with tempfile.TemporaryDirectory(prefix="switcheroo-bench-") as tmp:
+        root = Path(tmp) / "tree"
+        n_files = make_tree(root, args.old, config, 0)
+        print(f"tree: {n_files} files, {args.latency_ms} ms per open")
+        print(f"{'prefetch':>8} {'depth':>6} {'files/s':>9} {'speedup':>8} {'wait s':>8}")
+        baseline = 0.0
+        for n in threads:
+            depth = n * args.depth_per_thread if args.depth_per_thread else 0
+            best: sw.Stats | None = None
+            for _ in range(args.repeat):
+                with _open_latency(root, args.latency_ms / 1000), redirect_stdout(io.StringIO()):
+                    stats = sw.switcheroo(
+                        input_path=root,
+                        old_string=args.old,
+                        new_string=args.new,
+                        dry_run=True,
+                        dedup=False,
+                        prefetch=n,
+                        prefetch_depth=depth,
+                    )
+                if best is None or stats.files_per_second > best.files_per_second:
+                    best = stats
+            assert best is not None
+            rate = best.files_per_second
+            baseline = baseline or rate
+            wait = best.phase_seconds.get("wait", 0.0)
+            shown = (depth or 4 * n) if n else "-"
+            print(f"{n or '-':>8} {shown:>6} {rate:>9.0f} {rate / baseline:>7.2f}x {wait:>8.3f}")
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="Benchmarks for switcheroo.py.")
+    sub = p.add_subparsers(dest="bench", required=True)
+
+    m = sub.add_parser("matcher", help="Linear vs backtracking fuzzy matcher throughput.")
+    m.add_argument("--old", default="fabric", help="Lowercase old string (default: fabric).")
+    m.add_argument("--new", default="apollo", help="Lowercase new string (default: apollo).")
+    m.add_argument("--size-mb", type=float, default=4.0, help="Size of each input (default: 4).")
+    m.add_argument("--repeat", type=int, default=3, help="Best-of repetitions (default: 3).")
+
+    x = sub.add_parser("replace", help="Replacement engines on match-dense inputs.")
+    x.add_argument("--old", default="fabric", help="Lowercase old string (default: fabric).")
+    x.add_argument("--new", default="apollo", help="Lowercase new string (default: apollo).")
+    x.add_argument("--size-mb", type=float, default=4.0, help="Size of each input (default: 4).")
+    x.add_argument("--repeat", type=int, default=3, help="Best-of repetitions (default: 3).")
+
+    r = sub.add_parser("renames", help="Path-based vs directory-fd renames in a deep tree.")
+    r.add_argument("--depth", type=int, default=20, help="Directory nesting (default: 20).")
+    r.add_argument("--width", type=int, default=200, help="Files per directory (default: 200).")
+    r.add_argument("--repeat", type=int, default=3, help="Best-of repetitions (default: 3).")
+
+    t = sub.add_parser("tree", help="End-to-end runs on a synthetic tree, against a baseline.")
+    t.add_argument("--old", default="fabric", help="Lowercase old string (default: fabric).")
+    t.add_argument("--new", default="apollo", help="Lowercase new string (default: apollo).")
+    t.add_argument("--seed", type=int, default=0, help="Tree generator seed (default: 0).")
+    t.add_argument("--depth", type=int, default=3, help="Levels below the root (default: 3).")
+    t.add_argument("--fanout", type=int, default=4, help="Subdirs per directory (default: 4).")
+    t.add_argument("--files", type=int, default=20, help="Files per dir (default: 20).")
+    t.add_argument("--size-kb", type=float, default=4.0, help="Median size, KiB (default: 4).")
+    t.add_argument(
+        "--size-sigma", type=float, default=1.0, help="Log-normal size spread (default: 1)."
+    )
+    t.add_argument("--density", type=float, default=0.5, help="Matches per KiB (default: 0.5).")
+    t.add_argument(
+        "--non-utf8", type=float, default=0.05, help="Fraction of binary files (default: 0.05)."
+    )
+    t.add_argument(
+        "--symlinks", type=float, default=0.02, help="Symlinks per file (default: 0.02)."
+    )
+    t.add_argument(
+        "--separators",
+        type=float,
+        default=0.2,
+        help="Fraction of matches spelled with separators, e.g. f-a-b-r-i-c (default: 0.2).",
+    )
+    t.add_argument("-j", "--jobs", type=int, default=1, help="switcheroo() jobs (default: 1).")
+    t.add_argument("--repeat", type=int, default=3, help="Best-of repetitions (default: 3).")
+    t.add_argument("--baseline", type=Path, default=None, help="Baseline JSON to compare against.")
+    t.add_argument("--save-baseline", type=Path, default=None, help="Write this run as a baseline.")
+    t.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Allowed relative slowdown/growth before failing (default: 0.10).",
+    )
+
+    f = sub.add_parser("prefetch", help="Serial vs prefetched reads with injected open latency.")
+    f.add_argument("--old", default="fabric", help="Lowercase old string (default: fabric).")
+    f.add_argument("--new", default="apollo", help="Lowercase new string (default: apollo).")
+    f.add_argument("--latency-ms", type=float, default=2.0, help="Added per open (default: 2).")
+    f.add_argument(
+        "--threads",
+        default="2,4,8,16",
+        help="Comma-separated --prefetch values (default: 2,4,8,16).",
+    )
+    f.add_argument(
+        "--depth-per-thread",
+        type=int,
+        default=0,
+        help="--prefetch-depth per thread (default: 0, switcheroo's own default).",
+    )
+    f.add_argument("--depth", type=int, default=2, help="Levels below the root (default: 2).")
+    f.add_argument("--files", type=int, default=40, help="Files per dir (default: 40).")
+    f.add_argument("--size-kb", type=float, default=4.0, help="Median size, KiB (default: 4).")
+    f.add_argument("--repeat", type=int, default=3, help="Best-of repetitions (default: 3).")
+    return p
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = _build_parser().parse_args(argv)
+    if args.bench == "matcher":
+        bench_matcher(args.old, args.new, args.size_mb, args.repeat)
+    elif args.bench == "replace":
+        bench_replace(args.old, args.new, args.size_mb, args.repeat)
+    elif args.bench == "renames":
+        bench_renames(args.depth, args.width, args.repeat)
+    elif args.bench == "tree":
+        if args.threshold < 0:
+            _build_parser().error("--threshold must be >= 0")
+        return bench_tree(args)
+    elif args.bench == "prefetch":
+        bench_prefetch(args)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
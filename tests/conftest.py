@@ -0,0 +1,6 @@
+"""switcheroo.py is a standalone script: make it importable as `switcheroo`."""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src" / "eggduzao" / "core"))
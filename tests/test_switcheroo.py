@@ -0,0 +1,342 @@
+"""Behaviour of switcheroo runs over small trees, compared file by file."""
+
+from __future__ import annotations
+
+import errno
+import os
+import shutil
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Unpack
+
+import pytest
+import switcheroo as sw
+
+# Long enough for a few stream windows once the chunks are made small.
+_BIG = "".join(f"{'.' * (i % 11)}fabric Fabric_{i} F-A-B-R-I-C FABRIC\n" for i in range(400))
+
+_TREE: dict[str, str | bytes] = {
+    "fabric_notes.txt": "Fabric fabric FABRIC fab-ric fabricate\n",
+    "docs/FabricGuide.md": "# Fabric guide\n\nUse fabric_core, not FabricCore.\n",
+    "src/fabric/__init__.py": "from fabric import FabricClient\n",
+    "src/fabric/clean.py": "nothing to see here\n",
+    "src/one.py": "import fabric\n" * 50,
+    "src/two.py": "import fabric\n" * 50,
+    "src/café.txt": "café Fabric, naïve fabric\n",
+    "big/fabric.log": _BIG,
+    "data/fabric.bin": b"\0fabric\0" * 8,
+    "data/latin1.txt": "fabric caf\xe9".encode("latin-1"),
+}
+
+
+def _make_tree(root: Path, files: dict[str, str | bytes] = _TREE) -> Path:
+    for rel, content in files.items():
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(content, str):
+            path.write_text(content, encoding="utf-8")
+        else:
+            path.write_bytes(content)
+        _age(path)
+    return root
+
+
+def _age(path: Path) -> None:
+    """Date `path` an hour back, out of the manifest's racy window."""
+    past = time.time() - 3600
+    os.utime(path, (past, past))
+
+
+def _snapshot(root: Path) -> dict[str, bytes | None]:
+    """Every entry under `root` by relative path: file bytes, None for directories."""
+    return {
+        p.relative_to(root).as_posix(): None if p.is_dir() else p.read_bytes()
+        for p in sorted(root.rglob("*"))
+    }
+
+
+def _run(
+    root: Path, journal_path: Path | None = None, **options: Unpack[sw.SwitcherooOptions]
+) -> sw.Stats:
+    """Replace "fabric" with "apollo" under `root`, unless `options` say otherwise."""
+    options.setdefault("old_string", "fabric")
+    options.setdefault("new_string", "apollo")
+    return sw.switcheroo(
+        input_path=root, journal_path=journal_path, events=sw.QuietSink(), **options
+    )
+
+
+def test_replaces_and_renames(tmp_path: Path) -> None:
+    root = _make_tree(tmp_path / "tree")
+    _run(root)
+    after = _snapshot(root)
+    assert after["apollo_notes.txt"] == b"Apollo apollo APOLLO apollo apolloate\n"
+    assert after["src/apollo/__init__.py"] == b"from apollo import ApolloClient\n"
+    assert after["src/café.txt"] == "café Apollo, naïve apollo\n".encode()
+    # Binary and non-UTF-8 contents are left alone, but still renamed.
+    assert after["data/apollo.bin"] == b"\0fabric\0" * 8
+    assert not any("fabric" in rel.lower() for rel in after)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"jobs": 2},
+        {"prefetch": 2},
+        {"mmap_threshold": 1},
+        {"stream_threshold": 1},
+        {"stream_threshold": 1, "max_match_len": 16},
+        {"dedup": False},
+    ],
+    ids=["jobs", "prefetch", "mmap", "stream", "stream-narrow-window", "no-dedup"],
+)
+def test_content_paths_agree(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, options: sw.SwitcherooOptions
+) -> None:
+    expected = _make_tree(tmp_path / "expected")
+    _run(expected)
+    root = _make_tree(tmp_path / "tree")
+    # Small chunks: matches straddle chunk and window boundaries many times.
+    monkeypatch.setattr(sw, "_STREAM_CHUNK_SIZE", 64)
+    _run(root, **options)
+    assert _snapshot(root) == _snapshot(expected)
+
+
+def test_stream_window_straddles_every_offset(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    text = "".join("x" * i + "f_a_b_r_i_c\n" for i in range(64))
+    expected = _make_tree(tmp_path / "expected", {"a.txt": text})
+    _run(expected)
+    monkeypatch.setattr(sw, "_STREAM_CHUNK_SIZE", 7)
+    for max_match_len in (11, 12, 40):
+        root = _make_tree(tmp_path / f"tree{max_match_len}", {"a.txt": text})
+        stats = _run(root, stream_threshold=1, max_match_len=max_match_len)
+        assert stats.streamed_files == 1
+        assert _snapshot(root) == _snapshot(expected)
+
+
+def test_plan_then_apply_matches_live_run(tmp_path: Path) -> None:
+    expected = _make_tree(tmp_path / "expected")
+    live = _run(expected)
+    root = _make_tree(tmp_path / "tree")
+    before = _snapshot(root)
+    plan_path = tmp_path / "plan.ndjson"
+    sw.write_plan(
+        plan_path=plan_path,
+        input_path=root,
+        old_string="fabric",
+        new_string="apollo",
+        events=sw.QuietSink(),
+    )
+    assert _snapshot(root) == before
+
+    applied = sw.apply_plan(plan_path, events=sw.QuietSink())
+    assert _snapshot(root) == _snapshot(expected)
+    assert (applied.edited_files, applied.renamed_paths) == (live.edited_files, live.renamed_paths)
+    assert applied.stale_plan_entries == applied.rename_collisions == 0
+
+
+def test_apply_skips_files_changed_since_planned(tmp_path: Path) -> None:
+    root = _make_tree(tmp_path / "tree")
+    plan_path = tmp_path / "plan.ndjson"
+    sw.write_plan(
+        plan_path=plan_path,
+        input_path=root,
+        old_string="fabric",
+        new_string="apollo",
+        events=sw.QuietSink(),
+    )
+    (root / "src" / "one.py").write_text("import fabric  # changed\n", encoding="utf-8")
+    stats = sw.apply_plan(plan_path, events=sw.QuietSink())
+    assert stats.stale_plan_entries == 1
+    assert (root / "src" / "one.py").read_text(encoding="utf-8") == "import fabric  # changed\n"
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"stream_threshold": 1}, {"mmap_threshold": 1}, {"prefetch": 2}],
+    ids=["memory", "stream", "mmap", "prefetch"],
+)
+def test_undo_restores_contents_and_names(tmp_path: Path, options: sw.SwitcherooOptions) -> None:
+    root = _make_tree(tmp_path / "tree")
+    before = _snapshot(root)
+    journal_path = tmp_path / "journal.ndjson"
+    stats = _run(root, journal_path=journal_path, **options)
+    assert stats.edited_files and stats.renamed_paths
+    assert _snapshot(root) != before
+
+    undone = sw.undo_journal(journal_path, events=sw.QuietSink())
+    assert _snapshot(root) == before
+    assert (undone.edited_files, undone.renamed_paths) == (stats.edited_files, stats.renamed_paths)
+    assert undone.stale_plan_entries == undone.rename_collisions == 0
+
+
+def test_undo_leaves_changed_files_alone(tmp_path: Path) -> None:
+    root = _make_tree(tmp_path / "tree")
+    journal_path = tmp_path / "journal.ndjson"
+    _run(root, journal_path=journal_path)
+    (root / "src" / "one.py").write_text("edited by hand\n", encoding="utf-8")
+    stats = sw.undo_journal(journal_path, events=sw.QuietSink())
+    assert stats.stale_plan_entries == 1
+    assert (root / "src" / "one.py").read_text(encoding="utf-8") == "edited by hand\n"
+    assert (root / "fabric_notes.txt").exists()
+
+
+def test_manifest_skips_clean_files_until_they_change(tmp_path: Path) -> None:
+    root = _make_tree(tmp_path / "tree")
+    _run(root, manifest=True)
+    assert (root / sw.MANIFEST_NAME).exists()
+
+    again = _run(root, manifest=True)
+    assert again.manifest_skipped_files > 0
+    assert again.edited_files == 0
+
+    clean = root / "src" / "apollo" / "clean.py"
+    clean.write_text("now with fabric in it\n", encoding="utf-8")
+    _age(clean)
+    changed = _run(root, manifest=True)
+    assert changed.edited_files == 1
+    assert clean.read_text(encoding="utf-8") == "now with apollo in it\n"
+
+
+def test_manifest_is_per_replacement(tmp_path: Path) -> None:
+    root = _make_tree(tmp_path / "tree", {"a.txt": "nothing here\n", "b.txt": "gizmo\n"})
+    _run(root, manifest=True)
+    stats = _run(root, old_string="gizmo", new_string="widget", manifest=True)
+    assert stats.manifest_skipped_files == 0
+    assert (root / "b.txt").read_text(encoding="utf-8") == "widget\n"
+
+
+def _unreadable_once(monkeypatch: pytest.MonkeyPatch, name: str) -> None:
+    """Make the first `os.open` of a file called `name` fail with EACCES."""
+    real_open = os.open
+    failed = False
+
+    def flaky_open(path: Any, flags: int, *args: Any, **kwargs: Any) -> int:
+        nonlocal failed
+        if not failed and Path(os.fsdecode(path)).name == name:
+            failed = True
+            raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), path)
+        return real_open(path, flags, *args, **kwargs)
+
+    monkeypatch.setattr(os, "open", flaky_open)
+
+
+def test_manifest_does_not_record_unreadable_files(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    root = _make_tree(tmp_path / "tree", {"a.txt": "nothing here\n", "b.txt": "fabric\n"})
+    with monkeypatch.context() as m:
+        _unreadable_once(m, "b.txt")
+        first = _run(root, manifest=True)
+    assert first.skipped_files == {"unreadable": 1}
+    assert (root / "b.txt").read_text(encoding="utf-8") == "fabric\n"
+
+    again = _run(root, manifest=True)
+    assert again.manifest_skipped_files == 1
+    assert again.edited_files == 1
+    assert (root / "b.txt").read_text(encoding="utf-8") == "apollo\n"
+
+
+def _git(root: Path, *args: str) -> None:
+    subprocess.run(
+        ["git", "-c", "user.name=t", "-c", "user.email=t@example.com", *args],
+        cwd=root,
+        check=True,
+        capture_output=True,
+    )
+
+
+needs_git = pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+
+
+@needs_git
+def test_git_skips_clean_blobs_until_they_change(tmp_path: Path) -> None:
+    root = _make_tree(
+        tmp_path / "repo", {"a.txt": "nothing here\n", "b.txt": "fabric\n", "c.txt": "none\n"}
+    )
+    _git(root, "init", "-q")
+    _git(root, "add", ".")
+
+    first = _run(root, git=True)
+    assert first.edited_files == 1
+    _git(root, "add", ".")
+    again = _run(root, git=True)
+    # b.txt has a new blob since the first run, found clean only now.
+    assert again.blob_skipped_files == 2
+    assert _run(root, git=True).blob_skipped_files == 3
+
+    (root / "a.txt").write_text("fabric at last\n", encoding="utf-8")
+    _git(root, "add", ".")
+    changed = _run(root, git=True)
+    assert changed.edited_files == 1
+    assert (root / "a.txt").read_text(encoding="utf-8") == "apollo at last\n"
+
+
+@needs_git
+def test_git_does_not_cache_unreadable_blobs(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    root = _make_tree(tmp_path / "repo", {"a.txt": "nothing here\n", "b.txt": "fabric\n"})
+    _git(root, "init", "-q")
+    _git(root, "add", ".")
+    with monkeypatch.context() as m:
+        _unreadable_once(m, "b.txt")
+        first = _run(root, git=True)
+    assert first.skipped_files == {"unreadable": 1}
+
+    again = _run(root, git=True)
+    assert again.blob_skipped_files == 1
+    assert again.edited_files == 1
+    assert (root / "b.txt").read_text(encoding="utf-8") == "apollo\n"
+
+
+def test_gitignore_negation(tmp_path: Path) -> None:
+    root = _make_tree(
+        tmp_path / "tree",
+        {
+            ".gitignore": "*.log\n!keep.log\nbuild/\n",
+            "drop.log": "fabric\n",
+            "keep.log": "fabric\n",
+            "build/out.txt": "fabric\n",
+            "src/.gitignore": "!*.log\n",
+            "src/kept.log": "fabric\n",
+        },
+    )
+    _run(root, gitignore=True)
+    after = _snapshot(root)
+    assert after["drop.log"] == b"fabric\n"
+    assert after["build/out.txt"] == b"fabric\n"
+    assert after["keep.log"] == b"apollo\n"
+    assert after["src/kept.log"] == b"apollo\n"
+
+
+def test_exclude_negation(tmp_path: Path) -> None:
+    root = _make_tree(tmp_path / "tree", {"a/x.txt": "fabric\n", "a/y.txt": "fabric\n"})
+    _run(root, exclude=["a/*", "!a/y.txt"])
+    assert (root / "a" / "x.txt").read_text(encoding="utf-8") == "fabric\n"
+    assert (root / "a" / "y.txt").read_text(encoding="utf-8") == "apollo\n"
+
+
+def test_shards_partition_the_files(tmp_path: Path) -> None:
+    expected = _make_tree(tmp_path / "expected")
+    full = _run(expected)
+    root = _make_tree(tmp_path / "tree")
+    shards = 3
+    runs = [_run(root, shard=(i, shards)) for i in range(1, shards + 1)]
+    assert sum(s.renamed_paths for s in runs) == 0
+    assert sum(s.edited_files for s in runs) == full.edited_files
+    files = sum(1 for p in root.rglob("*") if p.is_file())
+    assert sum(s.shard_skipped_files for s in runs) == files * (shards - 1)
+
+    _run(root, renames_only=True)
+    assert _snapshot(root) == _snapshot(expected)
+
+
+def test_shard_of_is_stable_and_in_range() -> None:
+    rels = [f"dir{i % 7}/file{i}.txt" for i in range(500)]
+    shards = [sw._shard_of(rel, 4) for rel in rels]  # pyright: ignore[reportPrivateUsage]
+    assert set(shards) == {0, 1, 2, 3}
+    assert shards == [sw._shard_of(rel, 4) for rel in rels]  # pyright: ignore[reportPrivateUsage]